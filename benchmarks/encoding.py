@@ -0,0 +1,73 @@
+"""
+Compare the JSON encoders of the API messages with Flask's jsonify on large trees.
+
+The payload mimics the deep serialization of a folder holding files with several versions.
+
+Usage: python -m benchmarks.encoding [number of files]
+"""
+import datetime
+import sys
+import time
+
+from flask import jsonify
+
+from polydrive import app
+from polydrive.services.encoding import encoders, compress
+
+import env
+
+
+def make_tree(files, versions=3):
+    owner = {'id': 1, 'username': 'owner', 'email': 'owner@example.com'}
+    created = datetime.datetime(2018, 11, 20, 14, 30, 12, 123456)
+    children = []
+    for i in range(files):
+        children.append({
+            'id': i + 2, 'name': f'file-{i}', 'extension': 'txt', 'mime': 'text/plain',
+            'type': 'file', 'owner': owner, 'roles': [],
+            'versions': [{'id': i * versions + v, 'created': created, 'sha256': f'{i:064x}',
+                          'size': 1024 * v} for v in range(versions)]
+        })
+    return {'code': 200, 'status': 'OK', 'messages': ['OK'],
+            'content': {'id': 1, 'name': 'root', 'extension': None, 'mime': None,
+                        'type': 'folder', 'owner': owner, 'roles': [], 'children': children}}
+
+
+def measure(encode, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = encode()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, body
+
+
+def main(files):
+    payload = make_tree(files)
+    rows = []
+    for debug in [False, True]:
+        app.debug = debug
+        with app.test_request_context():
+            ms, body = measure(lambda: jsonify(payload).get_data())
+        rows.append((f'jsonify{" (debug)" if debug else ""}', ms, len(body)))
+    for name, encoder in sorted(encoders.items()):
+        ms, body = measure(lambda: encoder(payload))
+        rows.append((name, ms, len(body)))
+    body = encoders['json'](payload)
+    env.compression_threshold = 0
+    for encoding in ['gzip', 'br']:
+        with app.test_request_context(headers={'Accept-Encoding': encoding}):
+            headers = {}
+            ms, compressed = measure(lambda: compress(body, headers))
+            if headers.get('Content-Encoding', None) == encoding:
+                rows.append((f'json + {encoding}', ms, len(compressed)))
+
+    print(f'{files} files')
+    print(f'{"encoder":>20} {"ms":>10} {"bytes":>12}')
+    for name, ms, size in rows:
+        print(f'{name:>20} {ms:>10.1f} {size:>12}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
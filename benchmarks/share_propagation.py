@@ -0,0 +1,86 @@
+"""
+Measure the cost of sharing and revoking a folder as its size grows.
+
+The benchmark runs on a scratch SQLite database, every folder of the shared tree holding a view
+role of the guest made redundant by the edit role given on the root.
+
+Usage: python -m benchmarks.share_propagation [size ...]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from polydrive import app
+
+scratch = tempfile.mkdtemp(prefix='polydrive-bench-')
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(scratch, 'bench.db')
+app.config['UPLOAD_FOLDER'] = scratch
+
+from polydrive.config import db  # noqa: E402
+from polydrive.models import User, Resource, Role, role_type  # noqa: E402
+
+statements = [0]
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement(*args):
+    statements[0] += 1
+
+
+def build_tree(owner, guest, size, fan_out=10):
+    """
+    Create a folder holding size descendants, each shared in view with the guest.
+
+    :return: the root folder
+    """
+    root = Resource.create_folder(f'root-{size}', owner, None)
+    parents = [root]
+    created = 0
+    while created < size:
+        parent = parents.pop(0)
+        for _ in range(min(fan_out, size - created)):
+            folder = Resource.create_folder(f'folder-{created}', owner, parent)
+            db.session.add(Role(res_id=folder.id, user_id=guest.id, type=role_type.view))
+            parents.append(folder)
+            created += 1
+    Role.refresh_roots(root)
+    db.session.commit()
+    return root
+
+
+def measure(client, method, url):
+    statements[0] = 0
+    start = time.perf_counter()
+    rv = getattr(client, method)(url)
+    elapsed = (time.perf_counter() - start) * 1000
+    assert rv.status_code < 300, rv.data
+    return statements[0], elapsed
+
+
+def main(sizes):
+    with app.app_context():
+        db.create_all()
+        owner = User.create('owner', 'password', None)
+        guest = User.create('guest', 'password', None)
+        db.session.add_all([owner, guest])
+        db.session.commit()
+        roots = [(size, build_tree(owner, guest, size).id) for size in sizes]
+        guest_id = guest.id
+
+    print(f'{"size":>8} {"share sql":>10} {"share ms":>10} {"revoke sql":>11} {"revoke ms":>10}')
+    with app.test_client() as client:
+        client.post('/login', data=json.dumps({'username': 'owner', 'password': 'password'}),
+                    content_type='application/json')
+        for size, root_id in roots:
+            share = measure(client, 'post', f'/res/share/{root_id}/{guest_id}/{role_type.edit}')
+            revoke = measure(client, 'delete', f'/res/share/{root_id}/{guest_id}')
+            print(f'{size:>8} {share[0]:>10} {share[1]:>10.1f} {revoke[0]:>11} {revoke[1]:>10.1f}')
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 1000, 5000])
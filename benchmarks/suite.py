@@ -0,0 +1,566 @@
+"""
+Benchmark the API endpoints on generated datasets and compare the results with a baseline.
+
+Every dataset size is measured in its own process, on a scratch database filled by the
+synthetic dataset generator. The requests are sent either to the application in the same
+process, or to a local gunicorn server by several concurrent clients. For each endpoint the
+suite reports the p50, p95 and p99 latencies, the throughput and the number of SQL statements
+per request, and the peak memory of the serving processes for each dataset.
+
+The results are compared with the baseline file when it exists, and the suite exits with an
+error when a measure regressed beyond the threshold. The --save option records the results as
+the new baseline, which only makes sense on the machine the suite will be run on.
+
+Usage:
+    python -m benchmarks.suite [--sizes small,medium,large] [--requests 50]
+        [--server gunicorn] [--workers 4] [--concurrency 8]
+        [--baseline benchmarks/baseline.json] [--threshold 0.2] [--save]
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.cookies import SimpleCookie
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+presets = {
+    'small': {'users': 3, 'depth': 2, 'fan_out': 3, 'files': 3, 'blobs': 20},
+    'medium': {'users': 5, 'depth': 3, 'fan_out': 5, 'files': 5, 'blobs': 50},
+    'large': {'users': 10, 'depth': 4, 'fan_out': 6, 'files': 8, 'blobs': 100}
+}
+
+# Measures compared with the baseline, with the direction of an improvement.
+gates = [('p95', 'lower'), ('throughput', 'higher'), ('sql', 'lower')]
+# Latencies closer than this to the baseline are never reported as regressions.
+latency_slack = 1.0
+
+
+def write_env(scratch):
+    """
+    Write the env module of the benchmark: the current settings, on a scratch database.
+
+    :param scratch: the scratch directory
+    """
+    settings = {'secret_key': 'benchmark', 'environment': 'production'}
+    try:
+        import env
+        settings.update({name: value for name, value in vars(env).items()
+                         if not name.startswith('_') and
+                         isinstance(value, (str, int, float, bool, dict, list, type(None)))})
+        del sys.modules['env']
+    except ImportError:
+        pass
+    settings.update({
+        'debug': False,
+        'sql_uri': None,
+        'sql_replica_uri': None,
+        'sqlite_file': os.path.join(scratch, 'database.db'),
+        'upload_folder': os.path.join(scratch, 'uploads'),
+        'metrics_folder': os.path.join(scratch, 'metrics'),
+        'metrics_token': None,
+        'profile_folder': os.path.join(scratch, 'profiles'),
+        'sql_statistics': True
+    })
+    os.makedirs(settings['upload_folder'], exist_ok=True)
+    with open(os.path.join(scratch, 'env.py'), 'w') as f:
+        for name, value in sorted(settings.items()):
+            f.write(f'{name} = {value!r}\n')
+
+
+def prepare_dataset(scratch, size, tokens):
+    """
+    Create the scratch database and fill it with a generated dataset.
+
+    :param scratch: the scratch directory holding the env module
+    :param size: the name of the dataset preset
+    :param tokens: the number of token pairs to issue for the token scenarios
+    :return: the targets of the requests
+    """
+    sys.path.insert(0, scratch)
+    from polydrive import app
+    from polydrive.config import db
+    from polydrive.models import User, Resource, resource_type
+    from polydrive.services.database import init_db
+    from polydrive.services.dataset import generate_dataset, password
+    from polydrive.services.tokens import issue_tokens
+
+    with app.app_context():
+        init_db()
+        counts = generate_dataset(**presets[size])
+        users = User.query.order_by(User.id).limit(2).all()
+        owned = Resource.query.filter_by(owner_id=users[0].id)
+        root = owned.filter_by(parent_id=None).order_by(Resource.id).first()
+        leaf = owned.filter_by(type=resource_type.folder).order_by(Resource.id.desc()).first()
+        file = owned.filter_by(type=resource_type.file).order_by(Resource.id).first()
+        marker = Resource.create_folder(f'suite-{uuid.uuid4().hex}', users[0], None)
+        db.session.commit()
+        targets = {
+            'username': users[0].username,
+            'password': password,
+            'other_id': users[1].id,
+            'root_id': root.id,
+            'leaf_id': leaf.id,
+            'file_id': file.id,
+            'version_id': file.versions[0].id,
+            'marker': (marker.id, marker.name),
+            # Issuing tokens through the API would measure the password hashing.
+            'tokens': [issue_tokens(users[0]) for _ in range(tokens)],
+            'resources': counts['resources']
+        }
+        db.session.remove()
+    return app, targets
+
+
+class InProcessClient:
+    """
+    Send the requests to the application through Werkzeug's test client.
+    """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, content_type=None):
+        response = self.client.open(path, method=method, data=body, content_type=content_type)
+        data = response.get_data()
+        return response.status_code, response.headers, data
+
+
+class HttpClient:
+    """
+    Send the requests to a server on a persistent connection, keeping the session cookies.
+    """
+
+    def __init__(self, host, port):
+        self.connection = http.client.HTTPConnection(host, port, timeout=60)
+        self.cookies = SimpleCookie()
+
+    def request(self, method, path, body=None, content_type=None):
+        headers = {}
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        if len(self.cookies) > 0:
+            headers['Cookie'] = '; '.join(f'{k}={m.value}' for k, m in self.cookies.items())
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        for cookie in response.headers.get_all('Set-Cookie') or []:
+            self.cookies.load(cookie)
+        return response.status, response.headers, data
+
+
+def json_body(content):
+    return json.dumps(content).encode('utf-8'), 'application/json'
+
+
+def multipart_body(filename, data, name='file'):
+    return multipart_files([(filename, data)], name)
+
+
+def multipart_files(files, name):
+    boundary = uuid.uuid4().hex
+    body = b''.join((f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                     f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+                     ).encode('utf-8') + data + b'\r\n' for filename, data in files)
+    return body + f'--{boundary}--\r\n'.encode('utf-8'), f'multipart/form-data; boundary={boundary}'
+
+
+def login(client, targets):
+    body, content_type = json_body({'username': targets['username'],
+                                    'password': targets['password']})
+    status, _, _ = client.request('POST', '/login', body, content_type)
+    if status != 200:
+        raise RuntimeError(f'Cannot log in as {targets["username"]}')
+
+
+def check_database(client, targets):
+    """
+    Check that the server runs on the scratch database, by finding the folder only it holds.
+    """
+    marker_id, name = targets['marker']
+    status, _, data = client.request('GET', f'/res/{marker_id}?depth=0')
+    if status != 200 or json.loads(data)['content']['name'] != name:
+        raise RuntimeError('The server does not use the scratch database')
+
+
+def create_folder(client, targets, parent_id=None):
+    body, content_type = json_body({'name': f'bench-{uuid.uuid4().hex[:8]}', 'type': 'folder',
+                                    'parent_id': parent_id or targets['bench_id']})
+    status, _, data = client.request('POST', '/res', body, content_type)
+    if status != 201:
+        raise RuntimeError(f'Cannot create a folder: {data[:200]}')
+    return json.loads(data)['content']['id']
+
+
+def share_folder(client, targets):
+    res_id = create_folder(client, targets)
+    client.request('POST', f'/res/share/{res_id}/{targets["other_id"]}/view')
+    return res_id
+
+
+def upload(targets, prepared):
+    return ('POST', f'/res/upload/{targets["bench_id"]}') + \
+        multipart_body('bench.bin', os.urandom(16384))
+
+
+def upload_version(targets, prepared):
+    return ('POST', f'/res/{targets["file_id"]}/upload') + \
+        multipart_body('bench.bin', os.urandom(16384))
+
+
+def upload_tree(targets, prepared):
+    folder = f'bench-{uuid.uuid4().hex[:8]}'
+    return ('POST', f'/res/upload/tree/{targets["bench_id"]}') + multipart_files(
+        [(f'{folder}/d{i % 4}/f{i}.bin', os.urandom(4096)) for i in range(20)], 'files')
+
+
+def add_version(client, targets):
+    body, content_type = multipart_body('bench.bin', os.urandom(16384))
+    status, _, data = client.request('POST', f'/res/{targets["file_id"]}/upload', body,
+                                     content_type)
+    if status != 201:
+        raise RuntimeError(f'Cannot upload a version: {data[:200]}')
+    return max(version['id'] for version in json.loads(data)['content']['versions'])
+
+
+def batch(targets, prepared):
+    return ('POST', '/res/batch') + json_body({'operations': [
+        {'op': 'update', 'res_id': prepared, 'name': f'renamed-{uuid.uuid4().hex[:8]}'},
+        {'op': 'share', 'res_id': prepared, 'user_id': targets['other_id']},
+        {'op': 'revoke', 'res_id': prepared, 'user_id': targets['other_id']},
+        {'op': 'delete', 'res_id': prepared}
+    ]})
+
+
+def take_tokens(client, targets):
+    return targets['tokens'].pop()
+
+
+# The scenarios as (name, request factory, untimed preparation). The read-only endpoints are
+# measured first, so the writes do not change the dataset they run on.
+scenarios = [
+    ('home', lambda t, p: ('GET', '/'), None),
+    ('user', lambda t, p: ('GET', '/user'), None),
+    ('users', lambda t, p: ('GET', '/users'), None),
+    ('root', lambda t, p: ('GET', '/res'), None),
+    ('root_depth_1', lambda t, p: ('GET', '/res?depth=1'), None),
+    ('details', lambda t, p: ('GET', f'/res/{t["root_id"]}'), None),
+    ('details_depth_1', lambda t, p: ('GET', f'/res/{t["root_id"]}?depth=1'), None),
+    ('details_stream', lambda t, p: ('GET', f'/res/{t["root_id"]}?stream=1'), None),
+    ('shared', lambda t, p: ('GET', '/res/shared'), None),
+    ('version_details', lambda t, p: ('GET', f'/res/{t["file_id"]}/{t["version_id"]}'), None),
+    ('download', lambda t, p: ('GET', f'/res/{t["file_id"]}/download'), None),
+    ('version_download',
+     lambda t, p: ('GET', f'/res/{t["file_id"]}/{t["version_id"]}/download'), None),
+    ('archive', lambda t, p: ('GET', f'/res/{t["root_id"]}/archive'), None),
+    ('metrics', lambda t, p: ('GET', '/metrics'), None),
+    ('login', lambda t, p: ('POST', '/login') + json_body({'username': t['username'],
+                                                           'password': t['password']}), None),
+    ('create_folder', lambda t, p: ('POST', '/res') + json_body(
+        {'name': f'bench-{uuid.uuid4().hex[:8]}', 'type': 'folder',
+         'parent_id': t['bench_id']}), None),
+    ('rename', lambda t, p: ('PUT', f'/res/{t["leaf_id"]}') + json_body(
+        {'name': f'renamed-{uuid.uuid4().hex[:8]}'}), None),
+    ('move', lambda t, p: ('PUT', f'/res/{p}') + json_body({'parent_id': t['leaf_id']}),
+     create_folder),
+    ('share', lambda t, p: ('POST', f'/res/share/{p}/{t["other_id"]}/view'), create_folder),
+    ('share_tree', lambda t, p: ('POST', f'/res/share/{t["root_id"]}/{t["other_id"]}/edit'),
+     lambda c, t: c.request('DELETE', f'/res/share/{t["root_id"]}/{t["other_id"]}')),
+    ('revoke', lambda t, p: ('DELETE', f'/res/share/{p}/{t["other_id"]}'), share_folder),
+    ('upload', upload, None),
+    ('upload_version', upload_version, None),
+    ('upload_tree', upload_tree, None),
+    ('delete', lambda t, p: ('DELETE', f'/res/{p}'), create_folder),
+    ('delete_version', lambda t, p: ('DELETE', f'/res/{t["file_id"]}/{p}'), add_version),
+    ('batch', batch, create_folder),
+    ('token_refresh', lambda t, p: ('POST', '/token/refresh') + json_body(
+        {'refresh_token': p['refresh_token']}), take_tokens),
+    ('token_revoke', lambda t, p: ('POST', '/token/revoke') + json_body(
+        {'token': p['access_token']}), take_tokens),
+    # These scenarios change the user of the session, so they run last and the logout one logs
+    # the client in again before each request.
+    ('register', lambda t, p: ('POST', '/register') + json_body(
+        {'username': f'bench-{uuid.uuid4().hex}', 'password': t['password']}), None),
+    ('logout', lambda t, p: ('GET', '/logout'), login),
+]
+# The scenarios always editing the same rows, sent by a single client.
+serial = {'share_tree'}
+
+
+def percentile(values, rank):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(rank / 100 * len(ordered)) - 1)]
+
+
+def run_scenario(clients, targets, make_request, prepare, count):
+    """
+    Send the requests of a scenario, spread over the clients running concurrently.
+
+    The throughput of the scenarios needing an untimed preparation is derived from the mean
+    latency and the number of clients, since their wall-clock time includes the preparations.
+
+    :param clients: the logged in clients
+    :param targets: the targets of the requests
+    :param make_request: the request factory
+    :param prepare: the untimed preparation of each request, None if there is none
+    :param count: the number of requests
+    :return: a key-value dictionary of measures
+    """
+    latencies = []
+    statements = []
+    errors = []
+    lock = threading.Lock()
+
+    def work(client, share):
+        for _ in range(share):
+            prepared = prepare(client, targets) if prepare is not None else None
+            method, path, *body = make_request(targets, prepared)
+            start = time.perf_counter()
+            status, headers, _ = client.request(method, path, *body)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed * 1000)
+                statements.append(int(headers.get('X-SQL-Statements', 0)))
+                if status >= 400:
+                    errors.append(status)
+
+    shares = [count // len(clients) + (1 if i < count % len(clients) else 0)
+              for i in range(len(clients))]
+    start = time.perf_counter()
+    if len(clients) == 1:
+        work(clients[0], count)
+    else:
+        threads = [threading.Thread(target=work, args=(client, share))
+                   for client, share in zip(clients, shares)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    wall = time.perf_counter() - start
+    if prepare is None:
+        throughput = count / wall
+    else:
+        throughput = len(clients) * 1000 / (sum(latencies) / len(latencies))
+    return {
+        'p50': round(percentile(latencies, 50), 3),
+        'p95': round(percentile(latencies, 95), 3),
+        'p99': round(percentile(latencies, 99), 3),
+        'throughput': round(throughput, 1),
+        'sql': round(sum(statements) / len(statements), 2),
+        'errors': len(errors)
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(scratch, workers):
+    """
+    Start a gunicorn server on the scratch environment, and wait until it answers.
+
+    :param scratch: the scratch directory holding the env module
+    :param workers: the number of worker processes
+    :return: a tuple (process, port)
+    """
+    port = free_port()
+    # The scratch directory must come before the repository in the path, so its env module
+    # shadows the repository's one. Gunicorn's --pythonpath would insert the repository first.
+    python_path = os.pathsep.join([scratch, repository] + [
+        path for path in os.environ.get('PYTHONPATH', '').split(os.pathsep) if path])
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn.app.wsgiapp', '-w', str(workers), '-b', f'127.0.0.1:{port}',
+         '--log-level', 'warning', 'polydrive:app'],
+        cwd=scratch, env=dict(os.environ, PYTHONPATH=python_path))
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process, port
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+def peak_memory(pid):
+    """
+    Sum the peak resident memory of a process and its children.
+
+    :param pid: the process id
+    :return: the memory in MiB
+    """
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    total = 0
+    for child in pids:
+        try:
+            with open(f'/proc/{child}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return round(total / 1024, 1)
+
+
+def run_dataset(size, options):
+    """
+    Measure every scenario on a dataset, in the current process.
+
+    :param size: the name of the dataset preset
+    :param options: the command line options
+    :return: a key-value dictionary of results
+    """
+    scratch = tempfile.mkdtemp(prefix='polydrive-suite-')
+    write_env(scratch)
+    # Each token scenario takes a pair of tokens per request, warm-up included.
+    app, targets = prepare_dataset(scratch, size, 2 * (options.requests + 3))
+    process = None
+    if options.server == 'gunicorn':
+        process, port = start_gunicorn(scratch, options.workers)
+        clients = [HttpClient('127.0.0.1', port) for _ in range(options.concurrency)]
+    else:
+        clients = [InProcessClient(app)]
+    try:
+        for client in clients:
+            login(client, targets)
+        check_database(clients[0], targets)
+        targets['bench_id'] = create_folder(clients[0], targets, targets['leaf_id'])
+        results = {'resources': targets['resources'], 'scenarios': {}}
+        for name, make_request, prepare in scenarios:
+            senders = clients[:1] if name in serial else clients
+            run_scenario(senders, targets, make_request, prepare, min(3, options.requests))
+            results['scenarios'][name] = run_scenario(senders, targets, make_request, prepare,
+                                                      options.requests)
+            print(f'{size:>8} {name:<18} {results["scenarios"][name]}', file=sys.stderr)
+        if process is not None:
+            results['peak_rss_mb'] = peak_memory(process.pid)
+        else:
+            results['peak_rss_mb'] = round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        return results
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with a baseline.
+
+    :param results: the results, by dataset
+    :param baseline: the baseline, by dataset
+    :param threshold: the tolerated relative regression
+    :return: the list of regressions
+    """
+    regressions = []
+
+    def check(label, value, reference, direction, slack=0.0):
+        if direction == 'lower':
+            worse = value > reference * (1 + threshold) and value - reference > slack
+        else:
+            worse = value < reference * (1 - threshold)
+        if worse:
+            regressions.append(f'{label}: {reference} -> {value}')
+
+    for size, result in results.items():
+        reference = baseline.get(size, None)
+        if reference is None:
+            continue
+        for name, measures in result['scenarios'].items():
+            if measures['errors'] > 0:
+                regressions.append(f'{size} {name}: {measures["errors"]} failed requests')
+            if name not in reference['scenarios']:
+                continue
+            for measure, direction in gates:
+                check(f'{size} {name} {measure}', measures[measure],
+                      reference['scenarios'][name][measure], direction,
+                      latency_slack if measure == 'p95' else 0.0)
+        check(f'{size} peak_rss_mb', result['peak_rss_mb'], reference['peak_rss_mb'], 'lower')
+    return regressions
+
+
+def print_table(results):
+    print(f'{"dataset":>8} {"scenario":<18} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} '
+          f'{"req/s":>9} {"sql":>6} {"errors":>6}')
+    for size, result in results.items():
+        for name, m in result['scenarios'].items():
+            print(f'{size:>8} {name:<18} {m["p50"]:>9.2f} {m["p95"]:>9.2f} {m["p99"]:>9.2f} '
+                  f'{m["throughput"]:>9.1f} {m["sql"]:>6.1f} {m["errors"]:>6}')
+        print(f'{size:>8} {result["resources"]} resources, '
+              f'peak memory {result["peak_rss_mb"]} MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the API endpoints.')
+    parser.add_argument('--sizes', default='small,medium',
+                        help='the dataset presets, among ' + ', '.join(presets))
+    parser.add_argument('--requests', type=int, default=50,
+                        help='the number of measured requests per scenario')
+    parser.add_argument('--server', choices=['inprocess', 'gunicorn'], default='inprocess')
+    parser.add_argument('--workers', type=int, default=4, help='the gunicorn workers')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='the concurrent clients of the gunicorn server')
+    parser.add_argument('--baseline', default=os.path.join(repository, 'benchmarks',
+                                                           'baseline.json'))
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='the tolerated relative regression')
+    parser.add_argument('--save', action='store_true', help='record the results as baseline')
+    parser.add_argument('--dataset', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.dataset is not None:
+        json.dump(run_dataset(options.dataset, options), sys.stdout)
+        return 0
+
+    results = {}
+    for size in options.sizes.split(','):
+        if size not in presets:
+            parser.error(f'unknown dataset size {size}')
+        # Each dataset runs in a fresh process, for its own database and peak memory.
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.suite', '--dataset', size] + sys.argv[1:],
+            cwd=repository, stdout=subprocess.PIPE, check=True).stdout
+        results[size] = json.loads(output)
+    print_table(results)
+
+    baselines = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baselines = json.load(f)
+    if options.save:
+        baselines.setdefault(options.server, {}).update(results)
+        with open(options.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f'Baseline saved to {options.baseline}')
+        return 0
+    regressions = compare(results, baselines.get(options.server, {}), options.threshold)
+    for regression in regressions:
+        print('REGRESSION', regression)
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
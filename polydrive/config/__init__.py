@@ -2,4 +2,6 @@ from polydrive.config.bcrypt import bcrypt
 from polydrive.config.database import db
 from polydrive.config.login import login
 
+import polydrive.config.metrics
+import polydrive.config.profiling
 import polydrive.config.scripts
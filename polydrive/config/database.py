@@ -1,10 +1,119 @@
-from flask_sqlalchemy import SQLAlchemy
+import sqlite3
+
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine
 
 from polydrive import app
 from polydrive.config.files import make_path
 
 import env
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + make_path(env.sqlite_file)
+
+class RoutingSession(SignallingSession):
+    """
+    A session sending the queries of read-only requests to the replica.
+
+    Flushes always go to the primary database.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_app_context() and g.get('use_replica', False):
+            return self.db.get_engine(self.app, bind='replica')
+        return super().get_bind(mapper, clause)
+
+
+class Database(SQLAlchemy):
+    """
+    The database extension, with pooling options and read replica routing.
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+        if info.drivername != 'sqlite':
+            options.setdefault('pool_pre_ping', getattr(env, 'sql_pool_pre_ping', True))
+
+
+sql_uri = getattr(env, 'sql_uri', None)
+if sql_uri is None:
+    sql_uri = 'sqlite:///' + make_path(env.sqlite_file)
+app.config['SQLALCHEMY_DATABASE_URI'] = sql_uri
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
-db = SQLAlchemy(app)
+if not sql_uri.startswith('sqlite'):
+    app.config['SQLALCHEMY_POOL_SIZE'] = getattr(env, 'sql_pool_size', 10)
+    app.config['SQLALCHEMY_MAX_OVERFLOW'] = getattr(env, 'sql_max_overflow', 20)
+    app.config['SQLALCHEMY_POOL_TIMEOUT'] = getattr(env, 'sql_pool_timeout', 10)
+    app.config['SQLALCHEMY_POOL_RECYCLE'] = getattr(env, 'sql_pool_recycle', 3600)
+if getattr(env, 'sql_replica_uri', None) is not None:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': env.sql_replica_uri}
+db = Database(app)
+
+
+def increment_rows(table, column, rows):
+    """
+    Insert rows, or add their value of a column to the existing rows with the same key.
+
+    Each row is inserted or updated atomically by the database, so concurrent transactions
+    adding to the same new key do not fail on the primary key.
+
+    :param table: the table
+    :param column: the name of the incremented column
+    :param rows: a list of key-value dictionaries, all with the same keys
+    """
+    if len(rows) == 0:
+        return
+    dialect = db.session.get_bind().dialect
+    quote = dialect.identifier_preparer.quote
+    names = list(rows[0])
+    target = quote(column)
+    if dialect.name == 'mysql':
+        suffix = f'ON DUPLICATE KEY UPDATE {target} = {target} + VALUES({target})'
+    else:
+        keys = ', '.join(quote(key.name) for key in table.primary_key)
+        suffix = f'ON CONFLICT ({keys}) DO UPDATE SET ' \
+            f'{target} = {quote(table.name)}.{target} + excluded.{target}'
+    db.session.execute(db.text(
+        f'INSERT INTO {quote(table.name)} ({", ".join(quote(name) for name in names)}) '
+        f'VALUES ({", ".join(f":{name}" for name in names)}) {suffix}'), rows)
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Let concurrent processes share SQLite databases.
+
+    The write-ahead log lets readers work while a writer commits, and writers wait for the lock
+    instead of failing immediately.
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute(f'PRAGMA busy_timeout = {int(getattr(env, "sqlite_busy_timeout", 5000))}')
+    cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.execute('PRAGMA temp_store = MEMORY')
+    cursor.close()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        g.sql_statements = g.get('sql_statements', 0) + 1
+
+
+@app.after_request
+def report_statements(response):
+    """
+    Send the number of SQL statements issued by the request in the X-SQL-Statements header.
+    """
+    if getattr(env, 'sql_statistics', app.debug):
+        response.headers['X-SQL-Statements'] = str(g.get('sql_statements', 0))
+    return response
@@ -1,11 +1,180 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g
 from flask_login import LoginManager
+from sqlalchemy import event
 
 from polydrive import app
-from polydrive.models import User
+from polydrive.models import User, Counter
+from polydrive.services.tokens import decode_token, access_type
+
+import env
 
 login = LoginManager(app)
 
+identity_generation = 'users'
+
+
+class Identity:
+    """
+    The identity of the logged in user.
+
+    Holds the columns needed by most requests, the user model is only loaded when a view uses
+    another attribute.
+    """
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, username, email):
+        self.id = id
+        self.username = username
+        self.email = email
+        self._model = None
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    @property
+    def model(self):
+        """
+        The user model, loaded on first use.
+        """
+        if self._model is None:
+            self._model = User.query.get(self.id)
+        return self._model
+
+    def get_id(self):
+        return str(self.id)
+
+    @property
+    def serialized(self):
+        return {
+            'id': self.id,
+            'username': self.username,
+            'email': self.email
+        }
+
+
+class IdentityCache:
+    """
+    A bounded LRU cache of the identities of the logged in users.
+
+    Entries expire after a fixed time, and are invalidated when the user is modified by this
+    process. Other server processes notice the changes through a generation counter stored in
+    the database, and clear their own cache when it moved.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generation = None
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        """
+        Look for the identity of a user.
+
+        :param user_id: the user's id
+        :return: a tuple (id, username, email), None if it is not cached
+        """
+        with self.lock:
+            entry = self.entries.get(user_id, None)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(user_id, None)
+                return None
+            self.entries.move_to_end(user_id)
+            return entry[1]
+
+    def set(self, user):
+        """
+        Store the identity of a user.
+
+        :param user: the user
+        :return: a tuple (id, username, email)
+        """
+        identity = (user.id, user.username, user.email)
+        if self.size <= 0:
+            return identity
+        with self.lock:
+            self.entries[user.id] = (time.monotonic() + self.ttl, identity)
+            self.entries.move_to_end(user.id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return identity
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def sync(self, generation):
+        """
+        Clear the cache if the users were modified by another process.
+
+        :param generation: the generation counter read from the database
+        """
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+
+identity_cache = IdentityCache(getattr(env, 'user_cache_size', 10000),
+                               getattr(env, 'user_cache_ttl', 300))
+
+
+def sync_identities():
+    """
+    Check the identity cache generation against the database, once per request.
+    """
+    if not g.get('identities_synced', False):
+        identity_cache.sync(Counter.get(identity_generation))
+        g.identities_synced = True
+
 
 @login.user_loader
-def load_user(useres_id):
-    return User.query.get(useres_id)
+def load_user(user_id):
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return None
+    if identity_cache.size > 0:
+        sync_identities()
+    identity = identity_cache.get(user_id)
+    if identity is None:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        identity = identity_cache.set(user)
+    return Identity(*identity)
+
+
+@login.request_loader
+def load_user_from_request(request):
+    """
+    Authenticate the requests bearing an access token, without querying the database.
+    """
+    authorization = request.headers.get('Authorization', '')
+    if not authorization.startswith('Bearer '):
+        return None
+    claims = decode_token(authorization[len('Bearer '):].strip(), access_type)
+    if claims is None:
+        return None
+    return Identity(int(claims['sub']), claims['username'], claims['email'])
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def forget_identity(mapper, connection, target):
+    """
+    Forget the cached identity of a modified user, and tell the other processes through the
+    generation counter.
+    """
+    identity_cache.invalidate(target.id)
+    Counter.touch(identity_generation)
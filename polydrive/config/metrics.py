@@ -0,0 +1,66 @@
+import time
+
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from polydrive import app
+from polydrive.config.login import identity_cache
+from polydrive.services.cache import rights_cache
+from polydrive.services.metrics import metrics
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    """
+    Record the duration of the request and the SQL statements it issued, by endpoint.
+
+    Streamed bodies are produced after this point, so only the time to the response headers is
+    counted for them.
+    """
+    started = g.get('request_started', None)
+    if started is None:
+        return response
+    endpoint = request.endpoint or 'unknown'
+    metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                    endpoint=endpoint, method=request.method, status=response.status_code)
+    statements = g.get('sql_statements', 0)
+    if statements > 0:
+        metrics.inc('sql_statements_total', statements, endpoint=endpoint)
+        metrics.inc('sql_duration_seconds_total', g.get('sql_seconds', 0.0), endpoint=endpoint)
+    return response
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('statements_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['statements_started'].pop()
+    if has_app_context():
+        g.sql_seconds = g.get('sql_seconds', 0.0) + elapsed
+
+
+@event.listens_for(Engine, 'handle_error')
+def fail_statement(context):
+    if context.connection is not None and context.connection.info.get('statements_started'):
+        context.connection.info['statements_started'].pop()
+
+
+@metrics.register_collector
+def collect_caches():
+    stats = rights_cache.stats
+    return [
+        ('rights_cache_hits_total', stats['hits'], {}),
+        ('rights_cache_misses_total', stats['misses'], {}),
+        ('rights_cache_evictions_total', stats['evictions'], {}),
+        ('rights_cache_entries', stats['size'], {}),
+        ('identity_cache_entries', len(identity_cache.entries), {})
+    ]
@@ -0,0 +1,65 @@
+import datetime
+import random
+import time
+
+from flask import g, request
+from flask_login import current_user
+
+from polydrive import app
+from polydrive.services.profiling import recorders, dump_profile
+
+import env
+
+
+@app.before_request
+def start_profile():
+    """
+    Profile a sampled fraction of the requests, as set by the profile_sample_rate setting, with
+    the profiler setting's profiler.
+
+    When the profile_slow_threshold setting is set, the other requests are profiled with the
+    stack sampler, which barely slows them down, so the slow requests are caught whatever the
+    sample rate.
+    """
+    rate = getattr(env, 'profile_sample_rate', 0)
+    if rate > 0 and random.random() < rate:
+        profiler = getattr(env, 'profiler', 'cprofile')
+    elif getattr(env, 'profile_slow_threshold', None) is not None:
+        profiler = 'sampler'
+    else:
+        return
+    recorder = recorders[profiler]()
+    try:
+        recorder.start()
+    except ValueError:
+        # Another profiler is already running in this thread.
+        return
+    g.profile = (recorder, profiler, time.perf_counter(), datetime.datetime.now())
+
+
+@app.after_request
+def end_profile(response):
+    """
+    Dump the profile of the request, if it was slower than the profile_slow_threshold setting.
+    """
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    recorder, profiler, started, date = profile
+    recorder.stop()
+    duration = time.perf_counter() - started
+    if duration < (getattr(env, 'profile_slow_threshold', None) or 0):
+        return response
+    dump_profile({
+        'date': date.isoformat(),
+        'duration': duration,
+        'endpoint': request.endpoint or 'unknown',
+        'method': request.method,
+        'path': request.path,
+        'view_args': request.view_args,
+        'args': request.args.to_dict(flat=False),
+        'status': response.status_code,
+        'user': current_user.get_id() if current_user.is_authenticated else None,
+        'profiler': profiler
+    }, recorder.functions())
+    return response
@@ -1,5 +1,9 @@
 from polydrive import manager
-from polydrive.services.database import init_db, clear_db, fill_db
+from polydrive.models import Blob
+from polydrive.services.database import init_db, clear_db, fill_db, build_ancestries
+from polydrive.services.dataset import generate_dataset
+from polydrive.services.profiling import aggregate_profiles
+from polydrive.services.storage import shard_upload_folder
 
 
 @manager.command
@@ -13,3 +17,57 @@ def init_fake_database():
 def init_database():
     clear_db()
     init_db()
+
+
+@manager.command
+def rebuild_ancestries():
+    build_ancestries()
+
+
+@manager.command
+def reclaim_blobs():
+    Blob.reclaim_all()
+
+
+@manager.command
+def shard_uploads():
+    print(f'{shard_upload_folder()} blobs moved.')
+
+
+@manager.option('--users', type=int, default=10)
+@manager.option('--depth', type=int, default=3)
+@manager.option('--fan-out', dest='fan_out', type=int, default=4)
+@manager.option('--files', type=int, default=10)
+@manager.option('--versions', type=int, default=1)
+@manager.option('--shares', type=float, default=0.01)
+@manager.option('--blobs', type=int, default=100)
+@manager.option('--min-size', dest='min_size', type=int, default=1024)
+@manager.option('--max-size', dest='max_size', type=int, default=65536)
+@manager.option('--seed', type=int, default=0)
+def generate_data(users, depth, fan_out, files, versions, shares, blobs, min_size, max_size,
+                  seed):
+    init_db()
+    counts = generate_dataset(users, depth, fan_out, files, versions, shares, blobs, min_size,
+                              max_size, seed)
+    for table, count in counts.items():
+        print(f'{count} {table} inserted.')
+
+
+@manager.option('--top', type=int, default=30)
+@manager.option('--sort', choices=['own', 'cumulative'], default='own')
+@manager.option('--endpoint', default=None)
+def profile_report(top, sort, endpoint):
+    count, duration, functions = aggregate_profiles(endpoint)
+    print(f'{count} profiles, {duration:.3f} s in total.')
+    column = 1 if sort == 'own' else 2
+    ranked = sorted(functions.items(), key=lambda item: item[1][column], reverse=True)
+    print(f'{"own s":>10} {"cumul. s":>10} {"calls":>10} {"profiles":>8}  function')
+    for label, (calls, own, cumulative, profiles) in ranked[:top]:
+        print(f'{own:>10.4f} {cumulative:>10.4f} {calls:>10} {profiles:>8}  {label}')
+
+
+@manager.command
+def run_transfer(host='127.0.0.1', port=5001):
+    from aiohttp import web
+    from polydrive.transfer import application
+    web.run_app(application, host=host, port=port)
@@ -2,3 +2,4 @@ import polydrive.controllers.home
 import polydrive.controllers.user
 import polydrive.controllers.resource
 import polydrive.controllers.share
+import polydrive.controllers.metrics
@@ -0,0 +1,25 @@
+import hmac
+
+from flask import request, Response
+
+from polydrive import app
+from polydrive.services.messages import unauthorized
+from polydrive.services.metrics import exposition
+
+import env
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_get():
+    """
+    Export the metrics of all the server processes in the Prometheus text format.
+
+    When the metrics_token setting is defined, the scraper must send it as a Bearer token.
+
+    :return: the metrics
+    """
+    token = getattr(env, 'metrics_token', None)
+    if token is not None and \
+            not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return unauthorized('Invalid metrics token.')
+    return Response(exposition(), mimetype='text/plain; version=0.0.4')
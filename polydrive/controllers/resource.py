@@ -1,44 +1,76 @@
-from flask import request, send_file
+from flask import request, g
 from flask_login import login_required, current_user
 
 from polydrive import app
 from polydrive.config import db
-from polydrive.models import Resource, resource_type, Version
+from polydrive.models import Resource, resource_type, Version, Ancestry
 from polydrive.services import resource_action
-from polydrive.services.messages import bad_request, ok, created
+from polydrive.services.batch import Batch, batch_modes, atomic_mode, max_operations
+from polydrive.services.archive import send_archive
+from polydrive.services.download import send_version
+from polydrive.services.messages import bad_request, ok, created, ok_stream, build_message
 from polydrive.services.middleware import resource_middleware, file_version_middleware, \
-    parent_middleware, file_middleware
+    parent_middleware, file_middleware, extract_tree_options, replica_middleware
+from polydrive.services.upload import split_path
+from polydrive.services.resources import iter_resources, stream_list, stream_tree, load_trees
 
 
 @app.route('/res', methods=['GET'])
 @login_required
+@replica_middleware
 def root_content():
     """
     Get resources located in user's root.
 
-    Get the list of all user's resources with no parent.
+    Get the list of all user's resources with no parent. The "depth", "limit" and "cursor"
+    query parameters restrict the returned hierarchy, the id of the next page of root resources
+    is sent in the X-Next-Cursor header. The "stream" parameter streams the response.
 
     :return: user's resources in root folder
     """
-    resources = Resource.query.filter_by(owner_id=current_user.id, parent_id=None).all()
-    return ok('OK', [r.deep for r in resources])
+    options = extract_tree_options()
+    if options is None:
+        return bad_request('Invalid tree options.')
+    query = Resource.query.filter_by(owner_id=current_user.id, parent_id=None)
+    headers = {}
+    if options['stream'] and options['limit'] is None:
+        resources = iter_resources(query, options['cursor'])
+    else:
+        resources, next_cursor = Resource.paginate(query, options['limit'], options['cursor'])
+        if next_cursor is not None:
+            headers['X-Next-Cursor'] = str(next_cursor)
+        if options['limit'] is None:
+            load_trees(resources, options['depth'])
+    if options['stream']:
+        return ok_stream('OK', stream_list(resources, options['depth'], options['limit']), headers)
+    return ok('OK', [r.tree(options['depth'], options['limit']) for r in resources], headers)
 
 
 @app.route('/res/<int:res_id>', methods=['GET'])
 @login_required
+@replica_middleware
 @resource_middleware()
 def resource_details(res_id=None):
     """
     Get a resource's details.
 
     Return the specified resource's details. If the resource is a folder, the recursive
-    hierarchy is also returned.
+    hierarchy is also returned. The "depth", "limit" and "cursor" query parameters restrict
+    the returned hierarchy and the "stream" parameter streams the response.
 
     :param res_id: the requested resource's id
     :return: the requested resource's details
     """
-    file = Resource.query.get(res_id)
-    return ok('OK', file.deep)
+    options = extract_tree_options()
+    if options is None:
+        return bad_request('Invalid tree options.')
+    file = g.resource
+    if options['stream']:
+        return ok_stream('OK', stream_tree(file, options['depth'], options['limit'],
+                                           options['cursor']))
+    if options['limit'] is None and options['cursor'] is None:
+        load_trees([file], options['depth'])
+    return ok('OK', file.tree(options['depth'], options['limit'], options['cursor']))
 
 
 @app.route('/res', methods=['POST'])
@@ -70,11 +102,7 @@ def resource_create():
             messages.append('Not a valid type')
     if len(messages) > 0:
         return bad_request(messages)
-    parent_id = content.get('parent_id', None)
-    parent = None
-    if parent_id is not None:
-        parent = Resource.query.get(parent_id)
-    folder = Resource.create_folder(name, current_user, parent)
+    folder = Resource.create_folder(name, current_user, g.parent)
     db.session.commit()
     return created('Folder created', folder.deep)
 
@@ -90,12 +118,12 @@ def resource_delete(res_id):
     If the resource is a folder, all children are also deleted.
 
     :param res_id: the requested resource's id
-    :return: the deleted resource
+    :return: the deleted resource, without its descendants
     """
-    resource = Resource.query.get(res_id)
-    Resource.delete(resource)
+    json = g.resource.serialized
+    Resource.delete(g.resource)
     db.session.commit()
-    return ok('File successfully deleted.', resource.deep)
+    return ok('File successfully deleted.', json)
 
 
 @app.route('/res/<int:res_id>', methods=['PUT'])
@@ -109,7 +137,7 @@ def resource_update(res_id):
     :param res_id: the requested resource's id
     :return: the updated resource
     """
-    resource = Resource.query.get(res_id)
+    resource = g.resource
     content = request.get_json()
     params = {}
     if 'name' in content:
@@ -117,14 +145,49 @@ def resource_update(res_id):
     if 'extension' in content and resource.type == resource_type.file:
         params['extension'] = content['extension']
     if 'parent_id' in content:
-        parent_id = content['parent_id']
-        parent = Resource.query.get(parent_id) if parent_id is not None else None
-        params['parent'] = parent
-        if parent.owner.id != resource.owner.id:
+        params['parent'] = g.parent
+        if g.parent is not None and g.parent.owner_id != resource.owner_id:
             return bad_request('Resource cannot be moved here')
+        if g.parent is not None and Ancestry.contains(resource, g.parent):
+            return bad_request('Resource cannot be moved into itself')
     Resource.update(resource, **params)
     db.session.commit()
-    return ok('Resource updated', resource.deep)
+    return ok('Resource updated', load_trees([resource])[0].deep)
+
+
+@app.route('/res/batch', methods=['POST'])
+@login_required
+def resource_batch():
+    """
+    Run several operations on resources in one transaction.
+
+    The operations are "update" (name, extension and parent_id, like PUT /res/<id>), "delete",
+    "share" (user_id and type) and "revoke" (user_id), each holding the res_id of its resource.
+    In "atomic" mode, the default, nothing is applied if an operation fails. In "best_effort"
+    mode, the operations which fail are skipped and the others are applied.
+
+    :return: the result of each operation
+    """
+    content = request.get_json()
+    if content is None:
+        content = {}
+    operations = content.get('operations', None)
+    if not isinstance(operations, list) or len(operations) == 0 or \
+            not all(isinstance(op, dict) for op in operations):
+        return bad_request('Operations parameter required.')
+    if len(operations) > max_operations:
+        return bad_request(f'A batch cannot hold more than {max_operations} operations.')
+    mode = content.get('mode', atomic_mode)
+    if mode not in batch_modes:
+        return bad_request('Not a valid mode')
+    results, failure = Batch(current_user, operations).run(mode)
+    if failure is not None and mode == atomic_mode:
+        db.session.rollback()
+        return build_message(failure.code, failure.status,
+                             'The batch was cancelled, no operation was applied.', results)
+    db.session.commit()
+    succeeded = sum(1 for result in results if result['code'] < 400)
+    return ok(f'{succeeded} of {len(results)} operations applied.', results)
 
 
 @app.route('/res/upload', methods=['POST'])
@@ -147,17 +210,12 @@ def file_upload(parent_id=None):
     buffer = request.files['file']
     if buffer.filename == '':
         return bad_request('No selected file.')
-    replace_id = request.form.get('replace_id', None)
-    if replace_id is not None:
-        file = Resource.query.get(replace_id)
-        Resource.add_version(file, buffer)
+    if g.resource is not None:
+        Resource.add_version(g.resource, buffer)
         db.session.commit()
-        return created('File version uploaded.', file.deep)
-    owner = current_user
-    parent = None
-    if parent_id is not None:
-        parent = Resource.query.get(parent_id)
-        owner = parent.owner
+        return created('File version uploaded.', g.resource.deep)
+    parent = g.parent
+    owner = parent.owner if parent is not None else current_user
     f_details = buffer.filename.rsplit('.', 1)
     filename = f_details[0]
     extension = None
@@ -168,8 +226,37 @@ def file_upload(parent_id=None):
     return created('File uploaded.', file.deep)
 
 
+@app.route('/res/upload/tree', methods=['POST'])
+@app.route('/res/upload/tree/<int:parent_id>', methods=['POST'])
+@login_required
+@parent_middleware(action=resource_action.write)
+def tree_upload(parent_id=None):
+    """
+    Upload many files with their folders.
+
+    The files must be multi-part parameters called "files", each named after its path relative
+    to the parent folder. The missing folders are created and the existing ones are reused.
+
+    :param parent_id: the parent's id, null if root folder
+    :return: the created folders and files
+    """
+    buffers = [buffer for buffer in request.files.getlist('files') if buffer.filename != '']
+    if len(buffers) == 0:
+        return bad_request('Files parameter required.')
+    paths = [split_path(buffer.filename) for buffer in buffers]
+    invalid = [buffer.filename for buffer, path in zip(buffers, paths) if path is None]
+    if len(invalid) > 0:
+        return bad_request(f'Invalid paths: {", ".join(invalid)}')
+    parent = g.parent
+    owner = parent.owner if parent is not None else current_user
+    folders, files = Resource.create_tree(list(zip(paths, buffers)), owner, parent)
+    db.session.commit()
+    return created(f'{len(files)} files uploaded.', {'folders': folders, 'files': files})
+
+
 @app.route('/res/<int:res_id>/download', methods=['GET'])
 @login_required
+@replica_middleware
 @resource_middleware()
 @file_middleware
 def file_download(res_id):
@@ -181,8 +268,25 @@ def file_download(res_id):
     :param res_id: the requested file's id
     :return: the requested file's content
     """
-    file = Resource.query.get(res_id)
-    return send_file(file.last_version.real_path, mimetype=file.mime)
+    return send_version(g.resource.last_version, g.resource.mime)
+
+
+@app.route('/res/<int:res_id>/archive', methods=['GET'])
+@login_required
+@replica_middleware
+@resource_middleware()
+def folder_archive(res_id):
+    """
+    Download a folder and all its content as a ZIP archive.
+
+    The archive is built while it is sent, from the last version of each file.
+
+    :param res_id: the requested folder's id
+    :return: the archive
+    """
+    if g.resource.type != resource_type.folder:
+        return bad_request('Resource is not a folder.')
+    return send_archive(g.resource)
 
 
 @app.route('/res/<int:res_id>/upload', methods=['POST'])
@@ -197,17 +301,17 @@ def file_upload_version(res_id):
     """
     if 'file' not in request.files:
         return bad_request('File parameter required.')
-    file = Resource.query.get(res_id)
     buffer = request.files['file']
     if buffer.filename == '':
         return bad_request('No selected file.')
-    Resource.add_version(file, buffer)
+    Resource.add_version(g.resource, buffer)
     db.session.commit()
-    return created('File version uploaded.', file.deep)
+    return created('File version uploaded.', g.resource.deep)
 
 
 @app.route('/res/<int:res_id>/<int:version_id>', methods=['GET'])
 @login_required
+@replica_middleware
 @resource_middleware()
 @file_version_middleware
 def file_version_details(res_id, version_id):
@@ -218,8 +322,7 @@ def file_version_details(res_id, version_id):
     :param version_id: the version's id
     :return: the version's details
     """
-    version = Version.query.filter_by(id=version_id, res_id=res_id).first()
-    return ok('OK', version.serialized)
+    return ok('OK', g.version.serialized)
 
 
 @app.route('/res/<int:res_id>/<int:version_id>', methods=['DELETE'])
@@ -234,14 +337,14 @@ def file_version_delete(res_id, version_id):
     :param version_id: the version's id
     :return: the version's details
     """
-    version = Version.query.filter_by(id=version_id, res_id=res_id).first()
-    Version.delete(version)
+    Version.delete(g.version)
     db.session.commit()
-    return ok('File version successfully deleted.', version.serialized)
+    return ok('File version successfully deleted.', g.version.serialized)
 
 
 @app.route('/res/<int:res_id>/<int:version_id>/download', methods=['GET'])
 @login_required
+@replica_middleware
 @resource_middleware()
 @file_version_middleware
 def file_version_download(res_id, version_id):
@@ -252,5 +355,4 @@ def file_version_download(res_id, version_id):
     :param version_id: the version's id
     :return:
     """
-    version = Version.query.filter_by(id=version_id, res_id=res_id).first()
-    return send_file(version.real_path, mimetype=version.file.mime)
+    return send_version(g.version, g.resource.mime, immutable=True)
@@ -1,22 +1,47 @@
+from flask import g
 from flask_login import login_required, current_user
 
 from polydrive import app
 from polydrive.config import db
-from polydrive.models import Resource, User, Role, role_type
+from polydrive.models import Resource, Role, role_type
 from polydrive.services import resource_action
-from polydrive.services.messages import ok, created, conflict, bad_request
-from polydrive.services.middleware import resource_middleware, user_middleware
+from polydrive.services.messages import ok, created, conflict, bad_request, ok_stream
+from polydrive.services.middleware import resource_middleware, user_middleware, \
+    extract_tree_options, replica_middleware
+from polydrive.services.resources import load_trees, stream_list, iter_resources
 
 
 @app.route('/res/shared', methods=['GET'])
 @login_required
+@replica_middleware
 def shared_get():
     """
-    Get all resources shared with the user.
+    Get the resources shared with the user.
 
-    :return: the list of shared files, with complete hierarchy
+    Only the top-level shared resources are listed, without their content unless the "depth"
+    query parameter asks for it. The "limit" and "cursor" query parameters paginate the list,
+    the id of the next page is sent in the X-Next-Cursor header, and the "stream" parameter
+    streams the response.
+
+    :return: the list of shared resources
     """
-    return ok('OK', [r.resource.deep for r in current_user.roles])
+    options = extract_tree_options()
+    if options is None:
+        return bad_request('Invalid tree options.')
+    depth = options['depth'] if options['depth'] is not None else 0
+    query = Resource.query.join(Role).filter(Role.user_id == current_user.id, Role.root)
+    headers = {}
+    if options['stream'] and options['limit'] is None:
+        resources = iter_resources(query, options['cursor'])
+    else:
+        resources, next_cursor = Resource.paginate(query, options['limit'], options['cursor'])
+        if next_cursor is not None:
+            headers['X-Next-Cursor'] = str(next_cursor)
+        if options['limit'] is None:
+            load_trees(resources, depth)
+    if options['stream']:
+        return ok_stream('OK', stream_list(resources, depth, options['limit']), headers)
+    return ok('OK', [r.tree(depth, options['limit']) for r in resources], headers)
 
 
 @app.route('/res/share/<int:res_id>/<int:user_id>', methods=['POST'])
@@ -35,9 +60,7 @@ def share_resource(res_id, user_id, r_type=role_type.view):
     """
     if r_type not in role_type.values():
         return bad_request('Invalid sharing type')
-    res = Resource.query.get(res_id)
-    user = User.query.get(user_id)
-    role = Role.link(res, user, r_type)
+    role = Role.link(g.resource, g.target_user, r_type)
     if role is None:
         return conflict('Resource already shared with user.')
     db.session.commit()
@@ -49,8 +72,6 @@ def share_resource(res_id, user_id, r_type=role_type.view):
 @resource_middleware(action=resource_action.delete)
 @user_middleware
 def revoke_resource(res_id, user_id):
-    res = Resource.query.get(res_id)
-    user = User.query.get(user_id)
-    Role.unlink(res, user)
+    Role.unlink(g.resource, g.target_user)
     db.session.commit()
     return ok('Rights revoked on resource')
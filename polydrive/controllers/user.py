@@ -4,7 +4,8 @@ from flask_login import login_required, login_user, logout_user, current_user
 from polydrive import app
 from polydrive.config import bcrypt, db
 from polydrive.services.messages import ok, created, bad_request, unauthorized
-from polydrive.models import User
+from polydrive.models import User, RevokedToken
+from polydrive.services.tokens import issue_tokens, decode_token, revoke_token, refresh_type
 
 
 @app.route('/login', methods=['POST'])
@@ -26,10 +27,60 @@ def user_login():
     password = content.get('password', None)
     if not bcrypt.check_password_hash(user.password, password):
         return unauthorized('Wrong credentials.')
+    if content.get('tokens', False):
+        json = user.serialized
+        json['tokens'] = issue_tokens(user)
+        return ok('Login successful.', json)
     login_user(user)
     return ok('Login successful.', user.serialized)
 
 
+@app.route('/token/refresh', methods=['POST'])
+def token_refresh():
+    """
+    Exchange a refresh token for new tokens.
+
+    The refresh token is revoked, so it can only be used once.
+
+    :return: the new tokens
+    """
+    content = request.get_json()
+    if content is None:
+        content = {}
+    token = content.get('refresh_token', None)
+    if token is None:
+        return bad_request('Refresh token must be submitted.')
+    claims = decode_token(token, refresh_type)
+    if claims is None or RevokedToken.query.get(claims['jti']) is not None:
+        return unauthorized('Invalid token.')
+    user = User.query.get(int(claims['sub']))
+    if user is None:
+        return unauthorized('Invalid token.')
+    revoke_token(claims)
+    tokens = issue_tokens(user)
+    db.session.commit()
+    return ok('Token refreshed.', tokens)
+
+
+@app.route('/token/revoke', methods=['POST'])
+def token_revoke():
+    """
+    Revoke an access or refresh token.
+    """
+    content = request.get_json()
+    if content is None:
+        content = {}
+    token = content.get('token', None)
+    if token is None:
+        return bad_request('Token must be submitted.')
+    claims = decode_token(token)
+    if claims is None:
+        return bad_request('Invalid token.')
+    revoke_token(claims)
+    db.session.commit()
+    return ok('Token revoked.')
+
+
 @app.route('/logout', methods=['GET'])
 @login_required
 def user_logout():
@@ -1,4 +1,9 @@
 from polydrive.models.user import User
+from polydrive.models.blob import Blob
+from polydrive.models.chunk import Chunk
 from polydrive.models.version import Version
-from polydrive.models.resource import Resource, resource_type
+from polydrive.models.ancestry import Ancestry
+from polydrive.models.counter import Counter
+from polydrive.models.revoked_token import RevokedToken
 from polydrive.models.role import Role, role_type
+from polydrive.models.resource import Resource, resource_type
@@ -0,0 +1,93 @@
+from polydrive.config import db
+
+
+class Ancestry(db.Model):
+    """
+    The closure of the resource tree.
+
+    Links every resource to itself and to each of its ancestors, with the distance between both.
+    """
+    __tablename__ = 'ancestries'
+
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('resources.id'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('resources.id'), primary_key=True)
+    depth = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_ancestries_descendant_depth', 'descendant_id', 'depth'),
+    )
+
+    @staticmethod
+    def subtree(res_id, min_depth=0):
+        """
+        Select the ids of a resource and all its descendants.
+
+        The query is wrapped in a derived table so it can be used in statements modifying the
+        ancestries table itself.
+
+        :param res_id: the subtree's root id
+        :param min_depth: the minimum distance to the root, 1 to exclude the root itself
+        :return: a selectable of resource ids
+        """
+        sub = db.session.query(Ancestry.descendant_id.label('id')) \
+            .filter(Ancestry.ancestor_id == res_id, Ancestry.depth >= min_depth).subquery()
+        return db.select([sub.c.id])
+
+    @staticmethod
+    def link(res):
+        """
+        Insert the ancestry of a new resource.
+
+        The resource must have been flushed so its id is known.
+
+        :param res: the new resource
+        """
+        rows = db.session.query(Ancestry.ancestor_id, db.literal(res.id), Ancestry.depth + 1) \
+            .filter(Ancestry.descendant_id == res.parent_id)
+        db.session.execute(Ancestry.__table__.insert().from_select(
+            ['ancestor_id', 'descendant_id', 'depth'], rows))
+        db.session.add(Ancestry(ancestor_id=res.id, descendant_id=res.id, depth=0))
+
+    @staticmethod
+    def contains(res, other):
+        """
+        Check if a resource is in the subtree of another one, itself included.
+
+        :param res: the subtree's root
+        :param other: the checked resource
+        :return: if the resource is in the subtree
+        """
+        return Ancestry.query.filter_by(ancestor_id=res.id, descendant_id=other.id).count() > 0
+
+    @staticmethod
+    def move(res, parent):
+        """
+        Attach a resource and its whole subtree to a new parent.
+
+        :param res: the moved resource
+        :param parent: the new parent, None for the root folder
+        """
+        db.session.query(Ancestry) \
+            .filter(Ancestry.descendant_id.in_(Ancestry.subtree(res.id)),
+                    ~Ancestry.ancestor_id.in_(Ancestry.subtree(res.id))) \
+            .delete(synchronize_session=False)
+        if parent is None:
+            return
+        above = db.aliased(Ancestry)
+        below = db.aliased(Ancestry)
+        rows = db.session.query(above.ancestor_id, below.descendant_id,
+                                above.depth + below.depth + 1) \
+            .filter(above.descendant_id == parent.id, below.ancestor_id == res.id)
+        db.session.execute(Ancestry.__table__.insert().from_select(
+            ['ancestor_id', 'descendant_id', 'depth'], rows))
+
+    @staticmethod
+    def unlink(res):
+        """
+        Remove the ancestry of a deleted resource.
+
+        :param res: the deleted resource
+        """
+        with db.session.no_autoflush:
+            db.session.query(Ancestry).filter(Ancestry.descendant_id == res.id) \
+                .delete(synchronize_session=False)
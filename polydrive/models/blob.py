@@ -0,0 +1,205 @@
+import hashlib
+import os
+import tempfile
+
+from sqlalchemy import event
+
+from polydrive import app
+from polydrive.config import db
+from polydrive.config.database import increment_rows
+from polydrive.services import reclaimer
+
+
+class Blob(db.Model):
+    """
+    A content stored on the physical disk.
+
+    Blobs are identified by the SHA-256 of their content and shared by all the versions having
+    the same content. When the last version referencing it is deleted, the file is reclaimed in
+    background once the transaction is committed.
+    """
+    __tablename__ = 'blobs'
+
+    hash = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False)
+
+    @property
+    def real_path(self):
+        return Blob.path_of(self.hash)
+
+    @staticmethod
+    def path_of(hash):
+        """
+        Get the path of a content on the disk.
+
+        Contents are spread in two levels of directories named after the first digits of their
+        hash, so no directory holds too many entries.
+
+        :param hash: the content's hash
+        :return: the content's path
+        """
+        return os.path.join(app.config['UPLOAD_FOLDER'], hash[:2], hash[2:4], hash)
+
+    @staticmethod
+    def store(stream):
+        """
+        Store an uploaded content.
+
+        If the content is already known, its reference count is incremented and the upload is
+        discarded, otherwise the uploaded file is moved in place.
+
+        :param stream: the uploaded content
+        :return: the content's hash
+        """
+        if Blob.reference(stream.sha256, stream.size):
+            stream.save(Blob.path_of(stream.sha256))
+        stream.close()
+        return stream.sha256
+
+    @staticmethod
+    def store_all(streams):
+        """
+        Store many uploaded contents at once.
+
+        The reference counts are updated with a single statement whatever the number of
+        contents. The contents missing on the disk once they are referenced are moved in place,
+        and the other uploads are discarded.
+
+        :param streams: the uploaded contents
+        :return: the contents' hashes, in the same order
+        """
+        hashes = [stream.sha256 for stream in streams]
+        counts = {}
+        sizes = {}
+        for hash, stream in zip(hashes, streams):
+            counts[hash] = counts.get(hash, 0) + 1
+            sizes[hash] = stream.size
+        increment_rows(Blob.__table__, 'ref_count', [
+            {'hash': hash, 'size': sizes[hash], 'ref_count': count}
+            for hash, count in counts.items()])
+        stored = set()
+        for hash, stream in zip(hashes, streams):
+            path = Blob.path_of(hash)
+            if hash not in stored and not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                stream.save(path)
+            stored.add(hash)
+            stream.close()
+        return hashes
+
+    @staticmethod
+    def store_chunk(data):
+        """
+        Store a chunk of a content.
+
+        :param data: the chunk's bytes
+        :return: the chunk's hash
+        """
+        hash = hashlib.sha256(data).hexdigest()
+        if Blob.reference(hash, len(data)):
+            fd, path = tempfile.mkstemp(prefix='.chunk-', dir=app.config['UPLOAD_FOLDER'])
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(path, Blob.path_of(hash))
+        return hash
+
+    @staticmethod
+    def reference(hash, size):
+        """
+        Add a reference to a content, registering the content if it is unknown.
+
+        :param hash: the content's hash
+        :param size: the content's size
+        :return: if the content must be written on the disk
+        """
+        increment_rows(Blob.__table__, 'ref_count', [{'hash': hash, 'size': size, 'ref_count': 1}])
+        path = Blob.path_of(hash)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return True
+
+    @staticmethod
+    def release(hash):
+        """
+        Remove a reference to a content.
+
+        :param hash: the content's hash
+        """
+        with db.session.no_autoflush:
+            Blob.query.filter_by(hash=hash) \
+                .update({Blob.ref_count: Blob.ref_count - 1}, synchronize_session=False)
+            remaining = db.session.query(Blob.ref_count).filter_by(hash=hash).scalar()
+        if remaining is not None and remaining <= 0:
+            db.session.info.setdefault('orphans', set()).add(hash)
+
+    @staticmethod
+    def release_all(references):
+        """
+        Remove many references at once.
+
+        The references are counted with a single aggregate, and the counts are applied with a
+        single statement.
+
+        :param references: a selectable of a "hash" column, with one row per reference
+        """
+        refs = references.alias('refs')
+        table = Blob.__table__
+        with db.session.no_autoflush:
+            counts = [{'b_hash': row.hash, 'b_count': row.count} for row in db.session.execute(
+                db.select([refs.c.hash, db.func.count().label('count')])
+                .where(refs.c.hash.isnot(None)).group_by(refs.c.hash))]
+            if len(counts) == 0:
+                return
+            db.session.execute(table.update().where(table.c.hash == db.bindparam('b_hash'))
+                               .values(ref_count=table.c.ref_count - db.bindparam('b_count')),
+                               counts)
+            orphans = db.session.info.setdefault('orphans', set())
+            for i in range(0, len(counts), 500):
+                orphans.update(row.hash for row in db.session.query(Blob.hash).filter(
+                    Blob.hash.in_([count['b_hash'] for count in counts[i:i + 500]]),
+                    Blob.ref_count <= 0))
+
+    @staticmethod
+    def reclaim(hashes):
+        """
+        Remove the contents that are no longer referenced.
+
+        A content referenced again since it was released is kept. The rows are deleted before
+        the files, in the same transaction, so a concurrent upload of the same content waits
+        for the file to be removed and writes it again.
+
+        :param hashes: the hashes of the released contents
+        """
+        for i in range(0, len(hashes), 100):
+            batch = hashes[i:i + 100]
+            Blob.query.filter(Blob.hash.in_(batch), Blob.ref_count <= 0) \
+                .delete(synchronize_session=False)
+            kept = {row.hash for row in db.session.query(Blob.hash).filter(Blob.hash.in_(batch))}
+            for hash in batch:
+                if hash not in kept:
+                    try:
+                        os.remove(Blob.path_of(hash))
+                    except FileNotFoundError:
+                        pass
+            db.session.commit()
+
+    @staticmethod
+    def reclaim_all():
+        """
+        Remove all the contents that are no longer referenced.
+        """
+        Blob.reclaim([row.hash for row in db.session.query(Blob.hash).filter(Blob.ref_count <= 0)])
+
+
+@event.listens_for(db.session, 'after_commit')
+def reclaim_orphans(session):
+    orphans = session.info.pop('orphans', None)
+    if orphans:
+        reclaimer.submit(Blob.reclaim, sorted(orphans))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_orphans(session):
+    session.info.pop('orphans', None)
@@ -0,0 +1,16 @@
+from polydrive.config import db
+
+
+class Chunk(db.Model):
+    """
+    A part of a file version stored in chunked mode.
+
+    The chunks of a version are blobs, so the chunks shared by several versions are stored once.
+    """
+    __tablename__ = 'chunks'
+
+    version_id = db.Column(db.Integer, db.ForeignKey('versions.id'), primary_key=True)
+    position = db.Column(db.Integer, primary_key=True)
+    blob_hash = db.Column(db.String(64), db.ForeignKey('blobs.hash'), nullable=False)
+
+    blob = db.relationship('Blob', lazy='joined')
@@ -0,0 +1,55 @@
+from sqlalchemy import event
+
+from polydrive.config import db
+from polydrive.config.database import increment_rows
+
+
+class Counter(db.Model):
+    """
+    A named counter shared by all the server processes.
+    """
+    __tablename__ = 'counters'
+
+    name = db.Column(db.String(255), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def get(name):
+        """
+        Read the current value of a counter.
+
+        :param name: the counter's name
+        :return: the counter's value, 0 if it was never incremented
+        """
+        value = db.session.query(Counter.value).filter_by(name=name).scalar()
+        return value if value is not None else 0
+
+    @staticmethod
+    def increment(name):
+        """
+        Increment a counter.
+
+        :param name: the counter's name
+        """
+        increment_rows(Counter.__table__, 'value', [{'name': name, 'value': 1}])
+
+    @staticmethod
+    def touch(name):
+        """
+        Increment a counter once per transaction.
+
+        Enough for the counters telling the other processes that something changed, whatever
+        the number of changes.
+
+        :param name: the counter's name
+        """
+        touched = db.session.info.setdefault('touched_counters', set())
+        if name not in touched:
+            Counter.increment(name)
+            touched.add(name)
+
+
+@event.listens_for(db.session, 'after_transaction_end')
+def forget_touched_counters(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('touched_counters', None)
@@ -1,5 +1,6 @@
 from polydrive.config import db
-from polydrive.models import Version
+from polydrive.models import Version, Ancestry, Blob, Chunk, Role
+from polydrive.services.cache import invalidate_rights
 
 
 class Resource(db.Model):
@@ -18,10 +19,10 @@ class Resource(db.Model):
     owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     parent_id = db.Column(db.Integer, db.ForeignKey('resources.id'), nullable=True)
 
-    versions = db.relationship('Version', lazy='subquery', backref=db.backref('file', lazy=True))
+    versions = db.relationship('Version', lazy=True, backref=db.backref('file', lazy=True))
     parent = db.relationship('Resource', remote_side=[id], lazy=True,
-                             backref=db.backref('children', lazy='subquery'))
-    roles = db.relationship('Role', lazy='subquery', backref=db.backref('resource', lazy=True))
+                             backref=db.backref('children', lazy=True))
+    roles = db.relationship('Role', lazy=True, backref=db.backref('resource', lazy=True))
 
     @property
     def real_name(self):
@@ -42,23 +43,85 @@ class Resource(db.Model):
         }
 
     @property
-    def deep(self):
+    def node(self):
         json = self.serialized
         json['owner'] = self.owner.serialized
         if self.type == resource_type.file:
             json['versions'] = [v.serialized for v in self.versions]
-        if self.type == resource_type.folder:
-            json['children'] = [f.deep for f in self.children]
         json['roles'] = [r.deep for r in self.roles]
         return json
 
+    @property
+    def deep(self):
+        return self.tree()
+
+    def tree(self, depth=None, limit=None, cursor=None):
+        """
+        Serialize the resource with its descendants.
+
+        :param depth: the number of levels of children to include, None for the whole hierarchy
+        :param limit: the maximum number of children listed per folder, None for all of them
+        :param cursor: list only the direct children with a greater id
+        :return: a key-value dictionary
+        """
+        json = self.node
+        if self.type == resource_type.folder and depth != 0:
+            children, next_cursor = self.page_children(limit, cursor)
+            child_depth = depth - 1 if depth is not None else None
+            json['children'] = [f.tree(child_depth, limit) for f in children]
+            if next_cursor is not None:
+                json['next_cursor'] = next_cursor
+        return json
+
+    def page_children(self, limit=None, cursor=None):
+        """
+        Get a page of the children, ordered by id.
+
+        Children already loaded by the tree loader are paginated in memory, otherwise they are
+        queried.
+
+        :param limit: the page size, None for no limit
+        :param cursor: the id of the last child of the previous page
+        :return: a tuple (page, cursor of the next page or None if it is the last one)
+        """
+        if limit is None and cursor is None:
+            return self.children, None
+        if 'children' not in self.__dict__:
+            return Resource.paginate(Resource.query.filter_by(parent_id=self.id), limit, cursor)
+        children = [c for c in self.children if cursor is None or c.id > cursor]
+        if limit is not None and len(children) > limit:
+            return children[:limit], children[limit - 1].id
+        return children, None
+
+    @staticmethod
+    def paginate(query, limit=None, cursor=None):
+        """
+        Apply a keyset pagination on the resources' ids.
+
+        :param query: the query of resources
+        :param limit: the page size, None for no limit
+        :param cursor: the id of the last resource of the previous page
+        :return: a tuple (page, cursor of the next page or None if it is the last one)
+        """
+        if cursor is not None:
+            query = query.filter(Resource.id > cursor)
+        query = query.order_by(Resource.id)
+        if limit is None:
+            return query.all(), None
+        page = query.limit(limit + 1).all()
+        if len(page) > limit:
+            return page[:limit], page[limit - 1].id
+        return page, None
+
     @staticmethod
     def create(name, extension, owner, parent, buffer):
         mime = buffer.content_type
-        file = Resource(name=name, extension=extension, mime=mime, parent=parent, owner=owner,
-                        type=resource_type.file)
+        file = Resource(name=name, extension=extension, mime=mime, parent=parent,
+                        owner_id=owner.id, type=resource_type.file)
         file.versions.append(Version.create(file, buffer))
         db.session.add(file)
+        db.session.flush()
+        Ancestry.link(file)
         return file
 
     @staticmethod
@@ -69,13 +132,97 @@ class Resource(db.Model):
             res.extension = kwargs['extension']
         if 'parent' in kwargs:
             res.parent = kwargs['parent']
+            Ancestry.move(res, kwargs['parent'])
+            Role.refresh_roots(res)
+            invalidate_rights(res)
 
     @staticmethod
     def create_folder(name, owner, parent):
-        folder = Resource(name=name, owner=owner, parent=parent, type=resource_type.folder)
+        folder = Resource(name=name, owner_id=owner.id, parent=parent, type=resource_type.folder)
         db.session.add(folder)
+        db.session.flush()
+        Ancestry.link(folder)
         return folder
 
+    @staticmethod
+    def create_tree(files, owner, parent):
+        """
+        Create many files at once, with the folders of their paths.
+
+        The folders of each level are looked up with a single query, and the existing ones are
+        reused. The resources are inserted one by one to get their ids, while their ancestries and
+        versions are inserted in bulk.
+
+        :param files: a list of (path as a list of names, uploaded file) tuples
+        :param owner: the owner of the new resources
+        :param parent: the folder receiving the files, None for the root folder
+        :return: a tuple (created folders, created files), serialized with their paths
+        """
+        resources = Resource.__table__
+        root_id = parent.id if parent is not None else None
+        ancestries = {root_id: []}
+        if parent is not None:
+            ancestries[root_id] = [(row.ancestor_id, row.depth) for row in
+                                   db.session.query(Ancestry.ancestor_id, Ancestry.depth)
+                                   .filter(Ancestry.descendant_id == parent.id)]
+        ancestry_rows = []
+
+        def insert(values, parent_id):
+            res_id = db.session.execute(resources.insert(), dict(
+                values, owner_id=owner.id, parent_id=parent_id)).inserted_primary_key[0]
+            ancestries[res_id] = [(ancestor_id, depth + 1)
+                                  for ancestor_id, depth in ancestries[parent_id]] + [(res_id, 0)]
+            ancestry_rows.extend({'ancestor_id': ancestor_id, 'descendant_id': res_id,
+                                  'depth': depth} for ancestor_id, depth in ancestries[res_id])
+            return res_id
+
+        folder_ids = {(): root_id}
+        folders = []
+        levels = max(len(names) for names, _ in files) - 1 if len(files) > 0 else 0
+        for level in range(1, levels + 1):
+            paths = sorted({tuple(names[:level]) for names, _ in files if len(names) > level})
+            names = sorted({path[-1] for path in paths})
+            parent_ids = sorted({folder_ids[path[:-1]] for path in paths} - {None})
+            existing = {}
+            for i in range(0, len(names), 500):
+                query = db.session.query(Resource.id, Resource.name, Resource.parent_id) \
+                    .filter(Resource.type == resource_type.folder,
+                            Resource.name.in_(names[i:i + 500]))
+                if level == 1 and root_id is None:
+                    query = query.filter(Resource.parent_id.is_(None),
+                                         Resource.owner_id == owner.id)
+                else:
+                    query = query.filter(Resource.parent_id.in_(parent_ids))
+                for row in query.order_by(Resource.id.desc()):
+                    existing[(row.parent_id, row.name)] = row.id
+            for path in paths:
+                parent_id = folder_ids[path[:-1]]
+                folder_id = existing.get((parent_id, path[-1]), None)
+                if folder_id is None:
+                    folder_id = insert({'name': path[-1], 'type': resource_type.folder},
+                                       parent_id)
+                    folders.append({'id': folder_id, 'name': path[-1], 'extension': None,
+                                    'mime': None, 'type': resource_type.folder,
+                                    'path': '/'.join(path)})
+                else:
+                    ancestries[folder_id] = [(ancestor_id, depth + 1) for ancestor_id, depth
+                                             in ancestries[parent_id]] + [(folder_id, 0)]
+                folder_ids[path] = folder_id
+
+        created = []
+        uploads = []
+        for names, buffer in files:
+            f_details = names[-1].rsplit('.', 1)
+            values = {'name': f_details[0], 'extension': f_details[1] if len(f_details) > 1
+                      else None, 'mime': buffer.content_type, 'type': resource_type.file}
+            res_id = insert(values, folder_ids[tuple(names[:-1])])
+            created.append(dict(values, id=res_id, path='/'.join(names)))
+            uploads.append((res_id, buffer))
+        if len(ancestry_rows) > 0:
+            db.session.execute(Ancestry.__table__.insert(), ancestry_rows)
+        Version.create_all(uploads)
+        return folders, created
+
     @staticmethod
     def add_version(res, buffer):
         version = Version.create(res, buffer)
@@ -84,24 +231,41 @@ class Resource(db.Model):
 
     @staticmethod
     def delete(res):
-        if res.type == resource_type.file:
-            for version in res.versions:
-                Version.delete(version)
-        if res.type == resource_type.folder:
-            for child in res.children:
-                Resource.delete(child)
-        for role in res.roles:
-            role.delete()
-        db.session.delete(res)
+        """
+        Delete a resource and all its descendants.
 
-    @staticmethod
-    def get_rights(res, user):
-        for role in res.roles:
-            if role.user_id == user.id:
-                return role
-        if res.parent is not None:
-            return Resource.get_rights(res.parent, user)
-        return None
+        The rows of the whole subtree are removed with a few set-based statements. The blobs
+        which are no longer referenced are reclaimed in background after the commit.
+
+        :param res: the deleted resource
+        """
+        db.session.flush()
+        invalidate_rights(res)
+        versions = Version.__table__
+        chunks = Chunk.__table__
+        in_subtree = versions.c.res_id.in_(Ancestry.subtree(res.id))
+        Blob.release_all(db.union_all(
+            db.select([versions.c.blob_hash.label('hash')]).where(in_subtree),
+            db.select([chunks.c.blob_hash.label('hash')])
+            .select_from(chunks.join(versions, chunks.c.version_id == versions.c.id))
+            .where(in_subtree)))
+        res_ids = [row.id for row in db.session.execute(Ancestry.subtree(res.id))]
+        with db.session.no_autoflush:
+            db.session.execute(chunks.delete().where(
+                chunks.c.version_id.in_(db.select([versions.c.id]).where(in_subtree))))
+            db.session.execute(versions.delete().where(in_subtree))
+            db.session.execute(Role.__table__.delete().where(
+                Role.res_id.in_(Ancestry.subtree(res.id))))
+            for i in range(0, len(res_ids), 500):
+                batch = res_ids[i:i + 500]
+                db.session.execute(Resource.__table__.update()
+                                   .where(Resource.id.in_(batch)).values(parent_id=None))
+                db.session.execute(Ancestry.__table__.delete()
+                                   .where(Ancestry.descendant_id.in_(batch)))
+            for i in range(0, len(res_ids), 500):
+                db.session.execute(Resource.__table__.delete()
+                                   .where(Resource.id.in_(res_ids[i:i + 500])))
+        db.session.expire_all()
 
 
 class ResourceType:
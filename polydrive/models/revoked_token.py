@@ -0,0 +1,13 @@
+from polydrive.config import db
+
+
+class RevokedToken(db.Model):
+    """
+    A signed token revoked before its expiration.
+
+    Rows are only useful until the token expires, so expired ones are removed.
+    """
+    __tablename__ = 'revoked_tokens'
+
+    jti = db.Column(db.String(32), primary_key=True)
+    expires = db.Column(db.DateTime, nullable=False, index=True)
@@ -1,5 +1,6 @@
 from polydrive.config import db
-from polydrive.models import Resource
+from polydrive.models import Ancestry
+from polydrive.services.cache import invalidate_rights
 
 
 class Role(db.Model):
@@ -11,6 +12,11 @@ class Role(db.Model):
     res_id = db.Column(db.Integer, db.ForeignKey('resources.id'), primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
     type = db.Column(db.Text, nullable=False)
+    root = db.Column(db.Boolean, nullable=False, default=True)
+
+    __table_args__ = (
+        db.Index('ix_roles_user_root', 'user_id', 'root', 'res_id'),
+    )
 
     @property
     def serialized(self):
@@ -32,32 +38,84 @@ class Role(db.Model):
         existing = Role.query.filter_by(res_id=res.id, user_id=user.id).first()
         if existing is not None:
             existing.type = r_type
-            for r in res.children:
-                Role.unlink_deep(r, user, r_type)
+            Role.unlink_deep(res, user, r_type)
             return existing
-        existing = Resource.get_rights(res, user)
+        existing = Role.get_rights(res, user)
         if existing is None or (existing.type == role_type.view and r_type == role_type.edit):
-            role = Role(resource=res, user=user, type=r_type)
+            role = Role(resource=res, user=user, type=r_type, root=existing is None)
             db.session.add(role)
-            for r in res.children:
-                Role.unlink_deep(r, user, r_type)
+            Role.unlink_deep(res, user, r_type)
+            Role.refresh_roots(res, user)
             return role
         return None
 
+    @staticmethod
+    def get_rights(res, user):
+        """
+        Find the role of a user on the resource or on its nearest shared ancestor.
+
+        :param res: the resource
+        :param user: the user
+        :return: the nearest role, None if the resource is not shared with the user
+        """
+        return Role.query.join(Ancestry, Ancestry.ancestor_id == Role.res_id) \
+            .filter(Ancestry.descendant_id == res.id, Role.user_id == user.id) \
+            .order_by(Ancestry.depth).first()
+
     @staticmethod
     def unlink(res, user):
         role = Role.query.filter_by(res_id=res.id, user_id=user.id).first()
         if role is not None:
             role.delete()
+            invalidate_rights(res, user)
+            if role.root:
+                Role.refresh_roots(res, user)
         return role
 
+    @staticmethod
+    def refresh_roots(res, user=None):
+        """
+        Recompute which roles of a subtree are the top-level shares of their user.
+
+        A role is a root when its user has no role on any ancestor of the resource. The flags of
+        the whole subtree are updated with a single statement.
+
+        :param res: the subtree's root, None to update all the roles
+        :param user: only update the roles of this user, None for all users
+        """
+        above = db.aliased(Role)
+        covered = db.session.query(Ancestry.descendant_id, above.user_id) \
+            .join(above, above.res_id == Ancestry.ancestor_id).filter(Ancestry.depth > 0)
+        query = Role.query
+        if res is not None:
+            covered = covered.filter(Ancestry.descendant_id.in_(Ancestry.subtree(res.id)))
+            query = query.filter(Role.res_id.in_(Ancestry.subtree(res.id)))
+        if user is not None:
+            covered = covered.filter(above.user_id == user.id)
+            query = query.filter(Role.user_id == user.id)
+        covered = covered.subquery()
+        query.update({Role.root: ~db.tuple_(Role.res_id, Role.user_id).in_(
+            db.select([covered.c.descendant_id, covered.c.user_id]))}, synchronize_session=False)
+
     @staticmethod
     def unlink_deep(res, user, r_type):
-        role = Role.query.filter_by(res_id=res.id, user_id=user.id).first()
-        if role is not None and (r_type == role_type.edit or r_type == role_type.view == role.type):
-            role.delete()
-        for r in res.children:
-            Role.unlink_deep(r, user, r_type)
+        """
+        Remove the roles of a user on the descendants of a resource made redundant by a role.
+
+        An edit role makes all the roles below redundant, a view role only the view roles. The
+        roles are removed with a single statement and the cached rights of the user on the whole
+        subtree are forgotten.
+
+        :param res: the resource holding the role
+        :param user: the user
+        :param r_type: the type of the role
+        """
+        query = Role.query.filter(Role.user_id == user.id,
+                                  Role.res_id.in_(Ancestry.subtree(res.id, min_depth=1)))
+        if r_type == role_type.view:
+            query = query.filter(Role.type == role_type.view)
+        query.delete(synchronize_session=False)
+        invalidate_rights(res, user)
 
 
 class RoleType:
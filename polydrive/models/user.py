@@ -14,8 +14,8 @@ class User(db.Model):
     password = db.Column(db.String(255), nullable=False)
     email = db.Column(db.String(255), unique=True, nullable=True)
 
-    files = db.relationship('Resource', lazy=True, backref=db.backref('owner', lazy='subquery'))
-    roles = db.relationship('Role', lazy=True, backref=db.backref('user', lazy='subquery'))
+    files = db.relationship('Resource', lazy=True, backref=db.backref('owner', lazy=True))
+    roles = db.relationship('Role', lazy=True, backref=db.backref('user', lazy=True))
 
     @property
     def is_authenticated(self):
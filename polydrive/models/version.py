@@ -1,48 +1,177 @@
-import os
-import random
-import string
 import datetime
+import time
 
-from polydrive import app
 from polydrive.config import db
+from polydrive.models import Blob, Chunk
+from polydrive.services.chunking import split
+from polydrive.services.metrics import metrics
+from polydrive.services.upload import receive_upload, chunk_size
+
+import env
 
 
 class Version(db.Model):
     """
     The version of a file.
 
-    Represents a file version on the physical disk.
+    Represents a file version. Its content is either a single blob on the physical disk, or a
+    list of chunks when the chunked storage mode is enabled.
     """
     __tablename__ = 'versions'
 
     id = db.Column(db.Integer, primary_key=True)
-    random_string = db.Column(db.String(100), nullable=False, unique=True)
     res_id = db.Column(db.Integer, db.ForeignKey('resources.id'))
     created = db.Column(db.DateTime, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False)
+    size = db.Column(db.BigInteger, nullable=True)
+    blob_hash = db.Column(db.String(64), db.ForeignKey('blobs.hash'), nullable=True)
+
+    blob = db.relationship('Blob', lazy=True)
+    chunks = db.relationship('Chunk', lazy=True, order_by='Chunk.position',
+                             cascade='all, delete-orphan')
 
     @property
     def real_path(self):
-        return os.path.join(app.config['UPLOAD_FOLDER'], self.random_string)
+        """
+        The path of the content on the disk, None for a chunked version.
+        """
+        if self.blob_hash is None:
+            return None
+        return Blob.path_of(self.blob_hash)
+
+    def segments(self, offset=0, length=None):
+        """
+        Locate a part of the content on the disk.
+
+        :param offset: the position of the first byte
+        :param length: the number of bytes, None to go until the end
+        :return: a list of (path, position in the file, number of bytes) tuples
+        """
+        if length is None:
+            length = self.size - offset
+        parts = [(self.real_path, self.size)]
+        if self.blob_hash is None:
+            parts = [(Blob.path_of(c.blob_hash), c.blob.size) for c in self.chunks]
+        segments = []
+        for path, size in parts:
+            if length <= 0:
+                break
+            if offset >= size:
+                offset -= size
+                continue
+            segments.append((path, offset, min(size - offset, length)))
+            length -= size - offset
+            offset = 0
+        return segments
+
+    def iter_content(self, offset=0, length=None):
+        """
+        Read the content of the version.
+
+        The content is located on the disk when the method is called, so the generator only
+        reads files and can be consumed after the end of the request.
+
+        :param offset: the position of the first byte to read
+        :param length: the number of bytes to read, None to read until the end
+        :return: a generator of bytes
+        """
+        segments = self.segments(offset, length)
+
+        def read():
+            sent = 0
+            elapsed = 0.0
+            try:
+                for path, start, remaining in segments:
+                    started = time.perf_counter()
+                    with open(path, 'rb') as f:
+                        f.seek(start)
+                        while remaining > 0:
+                            data = f.read(min(chunk_size, remaining))
+                            if len(data) == 0:
+                                break
+                            remaining -= len(data)
+                            sent += len(data)
+                            elapsed += time.perf_counter() - started
+                            yield data
+                            started = time.perf_counter()
+            finally:
+                metrics.inc('blob_read_bytes_total', sent)
+                metrics.inc('blob_read_seconds_total', elapsed)
+
+        return read()
 
     @property
     def serialized(self):
         return {
             'id': self.id,
-            'created': self.created
+            'created': self.created,
+            'sha256': self.sha256,
+            'size': self.size
         }
 
     @staticmethod
     def create(file, buffer):
-        random_string = None
-        while random_string is None or Version.query.filter_by(random_string=random_string).first() is not None:
-            random_string = ''.join(random.choices(string.ascii_lowercase + string.digits, k=100))
-        version = Version(random_string=random_string, file=file,
-                          created=datetime.datetime.now(tz=datetime.timezone.utc))
-        buffer.save(version.real_path)
+        started = time.perf_counter()
+        stream = receive_upload(buffer)
+        blob_hash = None
+        chunks = []
+        if getattr(env, 'storage_mode', 'blob') == 'chunked':
+            stream.seek(0)
+            for position, data in enumerate(split(stream)):
+                chunks.append(Chunk(position=position, blob_hash=Blob.store_chunk(data)))
+            stream.close()
+        else:
+            blob_hash = Blob.store(stream)
+        metrics.inc('blob_write_bytes_total', stream.size)
+        metrics.inc('blob_write_seconds_total', time.perf_counter() - started)
+        version = Version(file=file, size=stream.size, sha256=stream.sha256, blob_hash=blob_hash,
+                          chunks=chunks, created=datetime.datetime.now(tz=datetime.timezone.utc))
         db.session.add(version)
         return version
 
+    @staticmethod
+    def create_all(files):
+        """
+        Create the first version of many new files at once.
+
+        The versions are inserted with a single statement, and so are their chunks in chunked
+        mode, where each version is inserted alone to get its id.
+
+        :param files: a list of (file id, uploaded file) tuples
+        :return: the inserted rows
+        """
+        started = time.perf_counter()
+        streams = [receive_upload(buffer) for _, buffer in files]
+        created = datetime.datetime.now(tz=datetime.timezone.utc)
+        rows = [{'res_id': res_id, 'created': created, 'sha256': stream.sha256,
+                 'size': stream.size, 'blob_hash': None}
+                for (res_id, _), stream in zip(files, streams)]
+        versions = Version.__table__
+        if getattr(env, 'storage_mode', 'blob') == 'chunked':
+            chunks = []
+            for row, stream in zip(rows, streams):
+                stream.seek(0)
+                hashes = [Blob.store_chunk(data) for data in split(stream)]
+                stream.close()
+                version_id = db.session.execute(versions.insert(), row).inserted_primary_key[0]
+                chunks.extend({'version_id': version_id, 'position': position, 'blob_hash': hash}
+                              for position, hash in enumerate(hashes))
+            if len(chunks) > 0:
+                db.session.flush()
+                db.session.execute(Chunk.__table__.insert(), chunks)
+        else:
+            for row, hash in zip(rows, Blob.store_all(streams)):
+                row['blob_hash'] = hash
+            if len(rows) > 0:
+                db.session.execute(versions.insert(), rows)
+        metrics.inc('blob_write_bytes_total', sum(row['size'] for row in rows))
+        metrics.inc('blob_write_seconds_total', time.perf_counter() - started)
+        return rows
+
     @staticmethod
     def delete(version):
-        os.remove(version.real_path)
+        if version.blob_hash is not None:
+            Blob.release(version.blob_hash)
+        for chunk in version.chunks:
+            Blob.release(chunk.blob_hash)
         db.session.delete(version)
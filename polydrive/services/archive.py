@@ -0,0 +1,173 @@
+import zipfile
+
+from flask import Response
+from sqlalchemy.orm.attributes import set_committed_value
+from werkzeug.urls import url_quote
+
+from polydrive.config import db
+from polydrive.models import Resource, Version, Chunk, Ancestry, resource_type
+from polydrive.services.upload import chunk_size
+
+compressed_mimes = {
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2',
+    'application/x-xz', 'application/x-7z-compressed', 'application/x-rar-compressed',
+    'application/vnd.rar', 'application/pdf', 'application/epub+zip', 'application/java-archive',
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/heic', 'image/avif',
+    'font/woff', 'font/woff2'
+}
+uncompressed_audio = {'audio/wav', 'audio/x-wav', 'audio/aiff', 'audio/x-aiff'}
+# Entries from this size use ZIP64 sizes, leaving room for the expansion of incompressible data.
+zip64_threshold = zipfile.ZIP64_LIMIT // 2
+
+
+def is_compressed(mime):
+    """
+    Check if the contents of a MIME type are already compressed, so deflating them is useless.
+
+    :param mime: the MIME type, None if unknown
+    :return: if the contents are compressed
+    """
+    if mime is None:
+        return False
+    mime = mime.split(';', 1)[0].strip().lower()
+    return mime in compressed_mimes or mime.startswith('video/') or \
+        (mime.startswith('audio/') and mime not in uncompressed_audio) or \
+        mime.endswith('+zip') or mime.startswith('application/vnd.openxmlformats-') or \
+        mime.startswith('application/vnd.oasis.opendocument.')
+
+
+def entry_name(res):
+    name = res.real_name if res.type == resource_type.file and res.extension else res.name
+    name = (name or '').replace('/', '_').replace('\\', '_')
+    return '_' if name in ['', '.', '..'] else name
+
+
+def archive_entries(root):
+    """
+    List the entries of the archive of a folder.
+
+    The whole subtree, the last version of each file and the chunks of the chunked versions
+    are loaded with a few queries, and the older versions are not loaded. Rights are inherited,
+    so every descendant of a readable folder is readable. Nothing is left to load, so the
+    archive can be built after the end of the request.
+
+    :param root: the archived folder
+    :return: a list of (path, last version or None for a folder, MIME type) tuples
+    """
+    resources = Resource.query.filter(Resource.id.in_(Ancestry.subtree(root.id))).all()
+    file_ids = sorted(res.id for res in resources if res.type == resource_type.file)
+    last_versions = {}
+    for i in range(0, len(file_ids), 500):
+        last = db.session.query(Version.res_id, db.func.max(Version.created).label('created')) \
+            .filter(Version.res_id.in_(file_ids[i:i + 500])).group_by(Version.res_id).subquery()
+        for version in Version.query.join(last, db.and_(Version.res_id == last.c.res_id,
+                                                        Version.created == last.c.created)) \
+                .order_by(Version.res_id, Version.id):
+            last_versions[version.res_id] = version
+    chunked = [v for v in last_versions.values() if v.blob_hash is None]
+    for i in range(0, len(chunked), 500):
+        batch = {v.id: v for v in chunked[i:i + 500]}
+        chunks = {version_id: [] for version_id in batch}
+        for chunk in Chunk.query.filter(Chunk.version_id.in_(batch)) \
+                .order_by(Chunk.version_id, Chunk.position):
+            chunks[chunk.version_id].append(chunk)
+        for version_id, version_chunks in chunks.items():
+            set_committed_value(batch[version_id], 'chunks', version_chunks)
+
+    children = {}
+    for res in sorted(resources, key=lambda r: r.id):
+        children.setdefault(res.parent_id, []).append(res)
+    entries = []
+
+    def walk(folder, prefix):
+        names = set()
+        for res in children.get(folder.id, []):
+            name = entry_name(res)
+            base, count = name, 1
+            while name.lower() in names:
+                count += 1
+                stem, dot, extension = base.rpartition('.')
+                name = f'{stem} ({count}).{extension}' if dot and res.type == resource_type.file \
+                    else f'{base} ({count})'
+            names.add(name.lower())
+            if res.type == resource_type.folder:
+                entries.append((f'{prefix}{name}/', None, None))
+                walk(res, f'{prefix}{name}/')
+            elif res.id in last_versions:
+                version = last_versions[res.id]
+                entries.append((prefix + name, version, res.mime))
+
+    walk(root, '')
+    return entries
+
+
+class ArchiveBuffer:
+    """
+    The non-seekable file the archive is written to, emptied each time its content is sent.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = bytes(self.data)
+        self.data.clear()
+        return data
+
+    def __len__(self):
+        return len(self.data)
+
+
+def iter_archive(entries):
+    """
+    Build a ZIP archive while it is sent.
+
+    Each content is read block by block and compressed, unless it is already compressed, and
+    the sizes are written after the contents since the output cannot be rewound. ZIP64
+    records are used for large entries and when the archive goes over 4 GiB.
+
+    :param entries: the entries listed by archive_entries
+    :return: a generator of bytes
+    """
+    buffer = ArchiveBuffer()
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as archive:
+        for path, version, mime in entries:
+            if version is None:
+                archive.writestr(zipfile.ZipInfo(path), b'')
+                continue
+            info = zipfile.ZipInfo(path, max(version.created.timetuple()[:6],
+                                             (1980, 1, 1, 0, 0, 0)))
+            info.compress_type = zipfile.ZIP_STORED if is_compressed(mime) \
+                else zipfile.ZIP_DEFLATED
+            info.file_size = version.size or 0
+            with archive.open(info, 'w', force_zip64=info.file_size >= zip64_threshold) as f:
+                for data in version.iter_content():
+                    f.write(data)
+                    if len(buffer) >= chunk_size:
+                        yield buffer.take()
+            if len(buffer) >= chunk_size:
+                yield buffer.take()
+    yield buffer.take()
+
+
+def send_archive(root):
+    """
+    Send the content of a folder as a streamed ZIP archive.
+
+    :param root: the folder
+    :return: the response
+    """
+    name = url_quote(f'{entry_name(root)}.zip')
+    headers = {
+        'Content-Disposition': f"attachment; filename*=UTF-8''{name}",
+        'Cache-Control': 'private, no-cache'
+    }
+    return Response(iter_archive(archive_entries(root)), status=200, headers=headers,
+                    mimetype='application/zip', direct_passthrough=True)
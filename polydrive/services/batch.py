@@ -0,0 +1,172 @@
+from polydrive.config import db
+from polydrive.models import Resource, Role, Ancestry, User, resource_type, role_type
+from polydrive.services import resource_action
+from polydrive.services.messages import ApiMessage
+from polydrive.services.resources import load_role_types, check_resource_rights
+
+import env
+
+
+atomic_mode = 'atomic'
+best_effort_mode = 'best_effort'
+batch_modes = [atomic_mode, best_effort_mode]
+max_operations = getattr(env, 'batch_max_operations', 1000)
+
+
+def is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def failure(code, status, messages):
+    return ApiMessage(code=code, status=status, messages=messages)
+
+
+class Batch:
+    """
+    A list of operations on resources run in a single transaction.
+
+    The resources, users and rights needed by all the operations are loaded up front with a
+    few bulk queries, so the rights are those of the user before the batch. Each operation is
+    checked right before it runs, and a failed operation does not write anything.
+    """
+
+    def __init__(self, user, operations):
+        self.user = user
+        self.operations = operations
+        self.resources = {}
+        self.users = {}
+        self.role_types = {}
+        self.deleted = set()
+        self.handlers = {
+            'update': self.update,
+            'delete': self.delete,
+            'share': self.share,
+            'revoke': self.revoke
+        }
+
+    def load(self):
+        res_ids = sorted({op.get(key) for op in self.operations for key in ['res_id', 'parent_id']
+                          if is_id(op.get(key, None))})
+        user_ids = sorted({op['user_id'] for op in self.operations
+                           if is_id(op.get('user_id', None))})
+        for i in range(0, len(res_ids), 500):
+            self.resources.update((res.id, res) for res in
+                                  Resource.query.filter(Resource.id.in_(res_ids[i:i + 500])))
+        for i in range(0, len(user_ids), 500):
+            self.users.update((user.id, user) for user in
+                              User.query.filter(User.id.in_(user_ids[i:i + 500])))
+        self.role_types = load_role_types(
+            [res for res in self.resources.values() if res.owner_id != self.user.id], self.user)
+
+    def run(self, mode):
+        """
+        Run the operations in order.
+
+        :param mode: atomic_mode to stop at the first failure, best_effort_mode to go on
+        :return: a tuple (list of results, first failure), the failure is None if every
+            operation succeeded
+        """
+        self.load()
+        results = []
+        first_failure = None
+        for index, op in enumerate(self.operations):
+            handler = self.handlers.get(op.get('op', None), None)
+            if handler is None:
+                result = failure(400, 'BAD REQUEST', 'Unknown operation.')
+            else:
+                result = handler(op)
+            json = result.envelope
+            json['index'] = index
+            if result.content is not None:
+                json['content'] = result.content
+            results.append(json)
+            if result.code >= 400 and first_failure is None:
+                first_failure = result
+                if mode == atomic_mode:
+                    break
+        return results, first_failure
+
+    def get_resource(self, op, key, action, missing='This resource does not exist.',
+                     denied='You cannot access this resource.'):
+        """
+        Find a resource of an operation and check the rights of the user on it.
+
+        :return: a tuple (resource, failure), the failure is None when the resource is usable
+        """
+        res_id = op.get(key, None)
+        if not is_id(res_id):
+            return None, failure(400, 'BAD REQUEST', f'No {key} provided.')
+        res = self.resources.get(res_id, None)
+        if res is None or res_id in self.deleted:
+            return None, failure(404, 'NOT FOUND', missing)
+        if not check_resource_rights(res, self.user, action, self.role_types):
+            return None, failure(401, 'UNAUTHORIZED', denied)
+        return res, None
+
+    def get_user(self, op):
+        user = self.users.get(op.get('user_id', None), None)
+        if user is None:
+            return None, failure(404, 'NOT FOUND', 'User not found.')
+        return user, None
+
+    def update(self, op):
+        res, error = self.get_resource(op, 'res_id', resource_action.write)
+        if error is not None:
+            return error
+        params = {}
+        if 'name' in op:
+            params['name'] = op['name']
+        if 'extension' in op and res.type == resource_type.file:
+            params['extension'] = op['extension']
+        if 'parent_id' in op:
+            parent = None
+            if op['parent_id'] is not None:
+                parent, error = self.get_resource(op, 'parent_id', resource_action.write,
+                                                  'Parent folder does not exist.',
+                                                  'You cannot access parent folder.')
+                if error is not None:
+                    return error
+                if parent.type != resource_type.folder:
+                    return failure(400, 'BAD REQUEST', 'Parent is not a folder.')
+                if parent.owner_id != res.owner_id:
+                    return failure(400, 'BAD REQUEST', 'Resource cannot be moved here')
+                if Ancestry.contains(res, parent):
+                    return failure(400, 'BAD REQUEST', 'Resource cannot be moved into itself')
+            params['parent'] = parent
+        Resource.update(res, **params)
+        return ApiMessage(messages='Resource updated', content=res.serialized)
+
+    def delete(self, op):
+        res, error = self.get_resource(op, 'res_id', resource_action.delete)
+        if error is not None:
+            return error
+        json = res.serialized
+        self.deleted.update(row.id for row in db.session.execute(Ancestry.subtree(res.id)))
+        Resource.delete(res)
+        return ApiMessage(messages='File successfully deleted.', content=json)
+
+    def share(self, op):
+        res, error = self.get_resource(op, 'res_id', resource_action.write)
+        if error is not None:
+            return error
+        user, error = self.get_user(op)
+        if error is not None:
+            return error
+        r_type = op.get('type', role_type.view)
+        if r_type not in role_type.values():
+            return failure(400, 'BAD REQUEST', 'Invalid sharing type')
+        role = Role.link(res, user, r_type)
+        if role is None:
+            return failure(409, 'CONFLICT', 'Resource already shared with user.')
+        return ApiMessage(code=201, status='CREATED', messages='Resource shared.',
+                          content=role.deep)
+
+    def revoke(self, op):
+        res, error = self.get_resource(op, 'res_id', resource_action.delete)
+        if error is not None:
+            return error
+        user, error = self.get_user(op)
+        if error is not None:
+            return error
+        Role.unlink(res, user)
+        return ApiMessage(messages='Rights revoked on resource')
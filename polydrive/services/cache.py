@@ -0,0 +1,149 @@
+import threading
+import time
+from collections import OrderedDict
+
+from polydrive.config import db
+from polydrive.models.ancestry import Ancestry
+from polydrive.models.counter import Counter
+
+import env
+
+
+rights_generation = 'rights'
+
+
+class RightsCache:
+    """
+    A bounded LRU cache of the effective role of users on resources.
+
+    Entries expire after a fixed time and are invalidated by the models whenever the roles of a
+    subtree change. Other server processes notice the changes through a generation counter
+    stored in the database, and clear their own cache when it moved.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.resources = {}
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.entries)
+        }
+
+    def get(self, user_id, res_id):
+        """
+        Look for the role of a user on a resource.
+
+        :param user_id: the user's id
+        :param res_id: the resource's id
+        :return: a tuple (found, role type), the role type is None when the user has no role
+        """
+        key = (user_id, res_id)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, user_id, res_id, r_type):
+        """
+        Store the role of a user on a resource.
+
+        :param user_id: the user's id
+        :param res_id: the resource's id
+        :param r_type: the role type, None when the user has no role
+        """
+        if self.size <= 0:
+            return
+        key = (user_id, res_id)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, r_type)
+            self.entries.move_to_end(key)
+            self.resources.setdefault(res_id, set()).add(user_id)
+            while len(self.entries) > self.size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, res_ids, user_id=None):
+        """
+        Forget the roles stored for some resources.
+
+        :param res_ids: the resources' ids
+        :param user_id: only forget the roles of this user, None for all users
+        """
+        with self.lock:
+            for res_id in res_ids:
+                users = self.resources.get(res_id, None)
+                if users is None:
+                    continue
+                if user_id is not None:
+                    users = users & {user_id}
+                for u_id in list(users):
+                    self._remove((u_id, res_id))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.resources.clear()
+
+    def sync(self, generation):
+        """
+        Clear the cache if the roles were modified by another process.
+
+        :param generation: the generation counter read from the database
+        """
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+    def _remove(self, key):
+        del self.entries[key]
+        user_id, res_id = key
+        users = self.resources[res_id]
+        users.discard(user_id)
+        if len(users) == 0:
+            del self.resources[res_id]
+
+
+rights_cache = RightsCache(getattr(env, 'rights_cache_size', 10000),
+                           getattr(env, 'rights_cache_ttl', 60))
+
+
+def invalidate_rights(res, user=None, deep=True):
+    """
+    Forget the cached rights on a resource, and on its descendants if asked.
+
+    The generation counter is also incremented, once per transaction, so the other processes
+    drop their cache.
+
+    :param res: the modified resource
+    :param user: only forget the rights of this user, None for all users
+    :param deep: if the descendants are also affected
+    """
+    with db.session.no_autoflush:
+        Counter.touch(rights_generation)
+        if len(rights_cache) == 0:
+            return
+        res_ids = [res.id]
+        if deep:
+            res_ids = [row.id for row in db.session.execute(Ancestry.subtree(res.id))]
+        rights_cache.invalidate(res_ids, user.id if user is not None else None)
@@ -0,0 +1,98 @@
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+min_size = 1024 * 1024
+max_size = 4 * 1024 * 1024
+mask = (1 << 18) - 1
+read_size = 1024 * 1024
+
+# The gear table must never change, otherwise the boundaries of stored contents would move.
+gear = [random.Random(i).getrandbits(64) for i in range(256)]
+# The masked bits of the hash only depend on the last bytes, as many as the bits of the mask.
+window = mask.bit_length()
+scan_size = 256 * 1024
+if numpy is not None:
+    masked_gear = numpy.array([g & mask for g in gear], dtype=numpy.uint32)
+
+
+def find_boundary(data):
+    """
+    Find the end of the first content-defined chunk with a gear rolling hash.
+
+    The first bytes are skipped since a chunk is at least min_size long. The hashes are computed
+    with vectorized operations when numpy is installed, otherwise byte by byte, with the same
+    boundaries.
+
+    :param data: the buffered content, starting with the chunk
+    :return: the length of the chunk, None if the buffer holds no boundary
+    """
+    if numpy is not None:
+        return find_boundary_vectorized(data)
+    h = 0
+    table = gear
+    for i in range(min_size, min(len(data), max_size)):
+        h = ((h << 1) + table[data[i]]) & 0xFFFFFFFFFFFFFFFF
+        if h & mask == 0:
+            return i + 1
+    if len(data) >= max_size:
+        return max_size
+    return None
+
+
+def find_boundary_vectorized(data):
+    """
+    Find the end of the first content-defined chunk, like find_boundary, with numpy.
+
+    The masked bits of the hash at each byte are the sum of the gear values of the last window
+    bytes, shifted by their distance. They are computed for a block of bytes at once, in 32-bit
+    integers which keep the masked bits exact.
+
+    :param data: the buffered content, starting with the chunk
+    :return: the length of the chunk, None if the buffer holds no boundary
+    """
+    end = min(len(data), max_size)
+    view = numpy.frombuffer(data, dtype=numpy.uint8, count=end)
+    for start in range(min_size, end, scan_size):
+        stop = min(start + scan_size, end)
+        first = max(min_size, start - window + 1)
+        values = masked_gear[view[first:stop]]
+        hashes = values.copy()
+        for distance in range(1, min(window, len(values))):
+            hashes[distance:] += numpy.left_shift(values[:-distance], numpy.uint32(distance))
+        hits = numpy.flatnonzero((hashes[start - first:] & numpy.uint32(mask)) == 0)
+        if len(hits) > 0:
+            return start + int(hits[0]) + 1
+    if len(data) >= max_size:
+        return max_size
+    return None
+
+
+def split(stream):
+    """
+    Split a content into content-defined chunks.
+
+    Inserting or removing bytes in a content only changes the chunks around the modification,
+    so consecutive versions of a file share most of their chunks.
+
+    :param stream: a readable binary stream
+    :return: a generator of chunks
+    """
+    data = b''
+    eof = False
+    while not eof or len(data) > 0:
+        while not eof and len(data) < max_size:
+            read = stream.read(read_size)
+            eof = len(read) == 0
+            data += read
+        if len(data) == 0:
+            break
+        boundary = find_boundary(data)
+        if boundary is None:
+            boundary = len(data)
+        yield data[:boundary]
+        data = data[boundary:]
@@ -5,7 +5,7 @@ from io import BytesIO
 from polydrive import app
 from polydrive.config import db
 from polydrive.config.files import make_path
-from polydrive.models import User
+from polydrive.models import User, Resource, Ancestry, Role
 
 
 def init_db():
@@ -16,6 +16,29 @@ def clear_db():
     db.drop_all()
 
 
+def build_ancestries():
+    """
+    Compute the ancestries of all resources from their parents, then the shared roots.
+
+    Used on databases created before the ancestries table existed.
+    """
+    db.create_all()
+    parents = dict(db.session.query(Resource.id, Resource.parent_id))
+    db.session.query(Ancestry).delete(synchronize_session=False)
+    rows = []
+    for res_id in parents:
+        depth = 0
+        current = res_id
+        while current is not None:
+            rows.append({'ancestor_id': current, 'descendant_id': res_id, 'depth': depth})
+            current = parents[current]
+            depth += 1
+    if len(rows) > 0:
+        db.session.execute(Ancestry.__table__.insert(), rows)
+    Role.refresh_roots(None)
+    db.session.commit()
+
+
 def fill_db(path):
     with app.test_client() as client:
         with open(make_path(path)) as f:
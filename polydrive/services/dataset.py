@@ -0,0 +1,185 @@
+import datetime
+import hashlib
+import os
+import random
+
+from polydrive.config import db, bcrypt
+from polydrive.models import User, Resource, Version, Ancestry, Role, Blob, Counter, \
+    resource_type, role_type
+from polydrive.services.cache import rights_generation
+
+batch_size = 5000
+password = 'password42'
+extensions = {
+    'txt': 'text/plain',
+    'md': 'text/markdown',
+    'pdf': 'application/pdf',
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'zip': 'application/zip'
+}
+
+
+class BulkWriter:
+    """
+    Insert rows in several tables by batches.
+
+    The tables are flushed together in the given order, so the rows referenced by foreign keys
+    are always inserted first.
+    """
+
+    def __init__(self, *tables):
+        self.tables = tables
+        self.rows = {table.name: [] for table in tables}
+        self.counts = {table.name: 0 for table in tables}
+
+    def add(self, table, row):
+        self.rows[table.name].append(row)
+        if len(self.rows[table.name]) >= batch_size:
+            self.flush()
+
+    def flush(self):
+        for table in self.tables:
+            rows = self.rows[table.name]
+            if len(rows) > 0:
+                db.session.execute(table.insert(), rows)
+                self.counts[table.name] += len(rows)
+                self.rows[table.name] = []
+
+
+def next_id(column):
+    return (db.session.query(db.func.max(column)).scalar() or 0) + 1
+
+
+def make_blobs(rng, count, min_size, max_size):
+    """
+    Write random contents in the blob store and register them with no reference.
+
+    :param rng: the random generator
+    :param count: the number of contents
+    :param min_size: the minimum size of a content
+    :param max_size: the maximum size of a content
+    :return: a list of (hash, size) tuples
+    """
+    blobs = {}
+    for _ in range(count):
+        size = rng.randint(min_size, max_size)
+        data = rng.getrandbits(8 * size).to_bytes(size, 'little') if size > 0 else b''
+        hash = hashlib.sha256(data).hexdigest()
+        path = Blob.path_of(hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        blobs[hash] = size
+    hashes = list(blobs)
+    known = set()
+    for i in range(0, len(hashes), 500):
+        known.update(row.hash for row in db.session.query(Blob.hash)
+                     .filter(Blob.hash.in_(hashes[i:i + 500])))
+    rows = [{'hash': hash, 'size': size, 'ref_count': 0}
+            for hash, size in blobs.items() if hash not in known]
+    if len(rows) > 0:
+        db.session.execute(Blob.__table__.insert(), rows)
+    return list(blobs.items())
+
+
+def generate_dataset(users=10, depth=3, fan_out=4, files=10, versions=1, shares=0.01,
+                     blobs=100, min_size=1024, max_size=65536, seed=0):
+    """
+    Insert a synthetic dataset straight into the database and the blob store.
+
+    Each user owns fan_out root folders, and each folder holds files and fan_out sub-folders
+    down to the given depth. Every resource is shared with another user with the given
+    probability. The versions pick their content among a pool of random blobs, so they share
+    contents like real files do. The same seed always builds the same dataset.
+
+    :param users: the number of users
+    :param depth: the number of levels of folders
+    :param fan_out: the number of sub-folders per folder
+    :param files: the number of files per folder
+    :param versions: the number of versions per file
+    :param shares: the probability of a resource to be shared
+    :param blobs: the number of distinct contents
+    :param min_size: the minimum size of a content
+    :param max_size: the maximum size of a content
+    :param seed: the seed of the random generator
+    :return: the number of inserted rows per table
+    """
+    rng = random.Random(seed)
+    pool = make_blobs(rng, blobs, min_size, max_size)
+    references = {}
+    hashed_password = bcrypt.generate_password_hash(password)
+    first_user = next_id(User.id)
+    user_ids = list(range(first_user, first_user + users))
+    ids = {'resource': next_id(Resource.id), 'version': next_id(Version.id)}
+    start = datetime.datetime(2018, 1, 1)
+    writer = BulkWriter(User.__table__, Resource.__table__, Version.__table__,
+                        Ancestry.__table__, Role.__table__)
+
+    for user_id in user_ids:
+        writer.add(User.__table__, {'id': user_id, 'username': f'user{user_id}',
+                                    'password': hashed_password, 'email': None})
+
+    def add_resource(owner, parents, inherited, **columns):
+        res_id = ids['resource']
+        ids['resource'] += 1
+        writer.add(Resource.__table__, dict(id=res_id, owner_id=owner,
+                                            parent_id=parents[-1] if parents else None,
+                                            **columns))
+        ancestors = parents + [res_id]
+        for distance, ancestor in enumerate(reversed(ancestors)):
+            writer.add(Ancestry.__table__, {'ancestor_id': ancestor, 'descendant_id': res_id,
+                                            'depth': distance})
+        if users > 1 and rng.random() < shares:
+            user = first_user + rng.randrange(users - 1)
+            if user >= owner:
+                user += 1
+            r_type = rng.choice(role_type.values())
+            held = inherited.get(user, None)
+            if held != role_type.edit and held != r_type:
+                writer.add(Role.__table__, {'res_id': res_id, 'user_id': user, 'type': r_type,
+                                            'root': held is None})
+                inherited = dict(inherited)
+                inherited[user] = r_type
+        return ancestors, inherited
+
+    def add_file(owner, parents, inherited, index):
+        extension = rng.choice(list(extensions))
+        ancestors, _ = add_resource(owner, parents, inherited, name=f'file-{index}',
+                                    extension=extension, mime=extensions[extension],
+                                    type=resource_type.file)
+        created = start + datetime.timedelta(seconds=rng.randint(0, 365 * 86400))
+        for _ in range(versions):
+            hash, size = rng.choice(pool)
+            references[hash] = references.get(hash, 0) + 1
+            writer.add(Version.__table__, {'id': ids['version'], 'res_id': ancestors[-1],
+                                           'created': created, 'sha256': hash, 'size': size,
+                                           'blob_hash': hash})
+            ids['version'] += 1
+            created += datetime.timedelta(seconds=rng.randint(60, 30 * 86400))
+
+    def add_folder(owner, parents, inherited, index, level):
+        ancestors, inherited = add_resource(owner, parents, inherited, name=f'folder-{index}',
+                                            extension=None, mime=None,
+                                            type=resource_type.folder)
+        for i in range(files):
+            add_file(owner, ancestors, inherited, i)
+        if level < depth:
+            for i in range(fan_out):
+                add_folder(owner, ancestors, inherited, i, level + 1)
+
+    for user_id in user_ids:
+        for i in range(fan_out):
+            add_folder(user_id, [], {}, i, 1)
+    writer.flush()
+
+    if len(references) > 0:
+        table = Blob.__table__
+        db.session.execute(table.update().where(table.c.hash == db.bindparam('b_hash'))
+                           .values(ref_count=table.c.ref_count + db.bindparam('b_count')),
+                           [{'b_hash': hash, 'b_count': count}
+                            for hash, count in references.items()])
+    Counter.increment(rights_generation)
+    db.session.commit()
+    return writer.counts
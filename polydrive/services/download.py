@@ -0,0 +1,168 @@
+import os
+
+from flask import request, Response
+from werkzeug.http import http_date
+
+from polydrive.services.metrics import metrics
+
+max_ranges = 16
+
+
+def content_ranges(version):
+    """
+    Compute the byte ranges requested by the Range header.
+
+    The header is ignored when it does not respect the If-Range precondition, or when it asks
+    for too many ranges.
+
+    :param version: the requested file version
+    :return: a list of (start, stop) tuples, None to send the whole content, an empty list if no
+        range can be satisfied
+    """
+    if request.range is None or request.range.units != 'bytes':
+        return None
+    if 'If-Range' in request.headers:
+        if_range = request.if_range
+        if if_range.etag != version.sha256 and \
+                (if_range.date is None or if_range.date != last_modified(version)):
+            return None
+    if len(request.range.ranges) > max_ranges:
+        return None
+    ranges = []
+    for start, stop in request.range.ranges:
+        if start < 0:
+            start, stop = max(version.size + start, 0), version.size
+        elif stop is None or stop > version.size:
+            stop = version.size
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def last_modified(version):
+    return version.created.replace(tzinfo=None, microsecond=0)
+
+
+def is_not_modified(version):
+    """
+    Check the If-None-Match and If-Modified-Since preconditions.
+
+    :param version: the requested file version
+    :return: if the client already holds the version's content
+    """
+    if 'If-None-Match' in request.headers:
+        return request.if_none_match.contains_weak(version.sha256)
+    if request.if_modified_since is not None:
+        return last_modified(version) <= request.if_modified_since
+    return False
+
+
+class BoundedFile:
+    """
+    A file read from its current position up to a given number of bytes.
+
+    The descriptor is still exposed, so servers can send the file with sendfile, bounded by the
+    Content-Length. Servers reading the file block by block stop at the limit.
+    """
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size) if size > 0 else b''
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def iter_file(version, start, stop):
+    """
+    Read a part of a version's content.
+
+    Whole blobs are handed to the server's file wrapper when it has one, so they are sent with
+    sendfile, and only the size of the transfer is recorded in the metrics. The file is bounded
+    to the requested part, for the servers which read it instead. Other contents are located
+    right away, so the body can be consumed after the end of the request.
+
+    :param version: the file version
+    :param start: the position of the first byte
+    :param stop: the position after the last byte
+    :return: an iterable of bytes
+    """
+    file_wrapper = request.environ.get('wsgi.file_wrapper', None)
+    if version.real_path is not None and file_wrapper is not None:
+        f = open(version.real_path, 'rb')
+        f.seek(start)
+        metrics.inc('blob_read_bytes_total', stop - start)
+        return file_wrapper(BoundedFile(f, stop - start))
+    return version.iter_content(start, stop - start)
+
+
+def iter_multipart(version, parts, end):
+    contents = [(head, version.iter_content(start, stop - start)) for head, start, stop in parts]
+
+    def read():
+        for head, content in contents:
+            yield head
+            yield from content
+            yield b'\r\n'
+        yield end
+
+    return read()
+
+
+def send_version(version, mimetype, immutable=False):
+    """
+    Send the content of a file version.
+
+    Versions are identified by the hash of their content, which is used as a strong ETag, and
+    conditional and range requests are supported. Chunked versions are reassembled while they
+    are streamed.
+
+    :param version: the file version
+    :param mimetype: the file's MIME type
+    :param immutable: if the requested URL always returns the same content
+    :return: the response
+    """
+    if mimetype is None:
+        mimetype = 'application/octet-stream'
+    headers = {
+        'ETag': f'"{version.sha256}"',
+        'Last-Modified': http_date(last_modified(version)),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, max-age=31536000, immutable' if immutable
+        else 'private, no-cache'
+    }
+    if is_not_modified(version):
+        return Response(status=304, headers=headers)
+    ranges = content_ranges(version)
+    if ranges is None:
+        headers['Content-Length'] = str(version.size)
+        return Response(iter_file(version, 0, version.size), status=200, headers=headers,
+                        mimetype=mimetype, direct_passthrough=True)
+    if len(ranges) == 0:
+        headers['Content-Range'] = f'bytes */{version.size}'
+        return Response(status=416, headers=headers)
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{version.size}'
+        headers['Content-Length'] = str(stop - start)
+        return Response(iter_file(version, start, stop), status=206, headers=headers,
+                        mimetype=mimetype, direct_passthrough=True)
+    boundary = os.urandom(16).hex()
+    parts = [((f'--{boundary}\r\nContent-Type: {mimetype}\r\n'
+               f'Content-Range: bytes {start}-{stop - 1}/{version.size}\r\n\r\n').encode(),
+              start, stop) for start, stop in ranges]
+    end = f'--{boundary}--\r\n'.encode()
+    headers['Content-Length'] = str(sum(len(head) + stop - start + 2 for head, start, stop in parts)
+                                    + len(end))
+    return Response(iter_multipart(version, parts, end), status=206, headers=headers,
+                    mimetype=f'multipart/byteranges; boundary={boundary}', direct_passthrough=True)
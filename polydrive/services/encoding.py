@@ -0,0 +1,98 @@
+import datetime
+import gzip
+import json
+
+from flask import request
+
+import env
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def default(obj):
+    """
+    Serialize the values the JSON encoders do not support natively.
+
+    :param obj: the value
+    :return: a serializable value
+    """
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def encode_json(obj):
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, default=default) \
+        .encode('utf-8')
+
+
+def encode_orjson(obj):
+    return orjson.dumps(obj, default=default)
+
+
+encoders = {
+    'json': encode_json
+}
+if orjson is not None:
+    encoders['orjson'] = encode_orjson
+
+
+def register_encoder(name, encoder):
+    """
+    Make a JSON encoder available to the env.json_encoder setting.
+
+    :param name: the encoder's name
+    :param encoder: a function serializing a value to UTF-8 encoded JSON
+    """
+    encoders[name] = encoder
+
+
+def encode(obj):
+    """
+    Serialize a value to compact JSON, with datetimes in ISO 8601 format.
+
+    The encoder is chosen by the env.json_encoder setting, the fastest available one is used by
+    default.
+
+    :param obj: the value
+    :return: the UTF-8 encoded JSON
+    """
+    name = getattr(env, 'json_encoder', None)
+    if name is None:
+        name = 'orjson' if 'orjson' in encoders else 'json'
+    return encoders[name](obj)
+
+
+def dumps(obj):
+    return encode(obj).decode('utf-8')
+
+
+def compress(body, headers):
+    """
+    Compress a response body if the client accepts it and the body is large enough.
+
+    Brotli is preferred when it is installed, gzip is used otherwise.
+
+    :param body: the response body
+    :param headers: the response headers, updated when the body is compressed
+    :return: the body to send
+    """
+    threshold = getattr(env, 'compression_threshold', 1024)
+    if threshold is None or len(body) < threshold:
+        return body
+    headers['Vary'] = 'Accept-Encoding'
+    if brotli is not None and request.accept_encodings['br'] > 0:
+        headers['Content-Encoding'] = 'br'
+        return brotli.compress(body, quality=getattr(env, 'brotli_quality', 4))
+    if request.accept_encodings['gzip'] > 0:
+        headers['Content-Encoding'] = 'gzip'
+        return gzip.compress(body, compresslevel=getattr(env, 'gzip_level', 6))
+    return body
@@ -1,4 +1,6 @@
-from flask import jsonify
+from flask import Response, stream_with_context
+
+from polydrive.services.encoding import encode, dumps, compress
 
 
 class ApiMessage:
@@ -9,24 +11,69 @@ class ApiMessage:
         if not isinstance(self.messages, list):
             self.messages = [self.messages]
         self.content = kwargs.get('content', None)
+        self.headers = kwargs.get('headers', None)
+        if self.headers is None:
+            self.headers = {}
 
-    def http_format(self):
-        json = {
+    @property
+    def envelope(self):
+        return {
             'code': self.code,
             'status': self.status,
             'messages': self.messages
         }
+
+    def http_format(self):
+        """
+        Build the response.
+
+        The message is encoded in compact JSON, and compressed when it is large enough.
+
+        :return: the response
+        """
+        json = self.envelope
         if self.content is not None:
             json['content'] = self.content
-        return jsonify(json), self.code
+        headers = dict(self.headers)
+        body = compress(encode(json), headers)
+        return Response(body, status=self.code, headers=headers, mimetype='application/json')
+
+    def stream_format(self):
+        """
+        Build a streamed response.
+
+        The content must be an iterable of JSON fragments, which are sent as they are produced.
+
+        :return: the response
+        """
+        head = dumps(self.envelope)[:-1]
 
+        def generate():
+            yield f'{head}, "content": '
+            for chunk in self.content:
+                yield chunk
+            yield '}'
 
-def build_message(code, status, messages=None, content=None):
-    return ApiMessage(code=code, status=status, messages=messages, content=content).http_format()
+        return Response(stream_with_context(generate()), status=self.code, headers=self.headers,
+                        mimetype='application/json')
 
 
-def ok(messages=None, content=None):
-    return build_message(200, 'OK', messages, content)
+def build_message(code, status, messages=None, content=None, headers=None):
+    return ApiMessage(code=code, status=status, messages=messages, content=content,
+                      headers=headers).http_format()
+
+
+def build_stream(code, status, messages=None, chunks=None, headers=None):
+    return ApiMessage(code=code, status=status, messages=messages, content=chunks,
+                      headers=headers).stream_format()
+
+
+def ok(messages=None, content=None, headers=None):
+    return build_message(200, 'OK', messages, content, headers)
+
+
+def ok_stream(messages=None, chunks=None, headers=None):
+    return build_stream(200, 'OK', messages, chunks, headers)
 
 
 def created(messages=None, content=None):
@@ -47,3 +94,7 @@ def not_found(messages=None, content=None):
 
 def conflict(messages=None, content=None):
     return build_message(409, 'CONFLICT', messages, content)
+
+
+def too_large(messages=None, content=None):
+    return build_message(413, 'PAYLOAD TOO LARGE', messages, content)
@@ -0,0 +1,296 @@
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+
+from polydrive.config.files import make_path
+
+import env
+
+
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+prefix = 'polydrive_'
+
+descriptions = {
+    'http_request_duration_seconds': ('histogram', 'Time to build the response of a request.'),
+    'sql_statements_total': ('counter', 'SQL statements issued by the requests.'),
+    'sql_duration_seconds_total': ('counter', 'Time spent running the SQL statements.'),
+    'blob_write_bytes_total': ('counter', 'Bytes of uploaded contents stored.'),
+    'blob_write_seconds_total': ('counter', 'Time spent storing uploaded contents.'),
+    'blob_read_bytes_total': ('counter', 'Bytes of contents sent.'),
+    'blob_read_seconds_total': ('counter', 'Time spent reading contents, except sendfile.'),
+    'rights_checks_total': ('counter', 'Checks of the rights of users on resources.'),
+    'rights_cache_hits_total': ('counter', 'Rights found in the rights cache.'),
+    'rights_cache_misses_total': ('counter', 'Rights missing from the rights cache.'),
+    'rights_cache_evictions_total': ('counter', 'Rights evicted from the rights cache.'),
+    'rights_cache_entries': ('gauge', 'Rights held by the rights caches.'),
+    'identity_cache_entries': ('gauge', 'Identities held by the identity caches.')
+}
+
+
+def labels_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class Registry:
+    """
+    The metrics of the server process.
+
+    The values are written at a fixed interval to a file of the metrics folder named after the
+    process id and a random id, so a process reusing the id of a stopped one never overwrites
+    its file. The exported metrics add up the files of the live processes, so all the workers of
+    a server are counted, whichever of them answers the scrape. The counters and histograms of
+    a stopped worker are merged into an aggregate file, so the totals never decrease, and its
+    gauges are dropped.
+    """
+
+    def __init__(self, folder, interval):
+        self.folder = folder
+        self.interval = interval
+        self.collectors = []
+        self.reset()
+
+    def reset(self):
+        """
+        Start the values of a new process.
+
+        Called in the child processes after a fork, so a worker forked from a server which
+        loaded the application does not count the values of its parent again.
+        """
+        self.counters = {}
+        self.histograms = {}
+        self.name = None
+        self.pid = None
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increment a counter.
+
+        :param name: the metric's name
+        :param value: the increment
+        :param labels: the metric's labels
+        """
+        key = (name, labels_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self._touch()
+
+    def observe(self, name, value, **labels):
+        """
+        Add a value to a histogram.
+
+        :param name: the metric's name
+        :param value: the observed value
+        :param labels: the metric's labels
+        """
+        key = (name, labels_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * len(buckets) + [0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+            self._touch()
+
+    def register_collector(self, collector):
+        """
+        Add a function giving the current values of some gauges and counters.
+
+        The collectors are called before the values are written, and return a list of
+        (name, value, labels) tuples which replace the previous values.
+
+        :param collector: the function
+        :return: the function
+        """
+        self.collectors.append(collector)
+        return collector
+
+    def snapshot(self):
+        """
+        Get the values of the process.
+
+        :return: a serializable dictionary
+        """
+        collected = [(name, labels_key(labels), value)
+                     for collector in self.collectors for name, value, labels in collector()]
+        with self.lock:
+            counters = dict(self.counters)
+            counters.update({(name, key): value for name, key, value in collected})
+            return {
+                'counters': [[name, list(key), value] for (name, key), value in counters.items()],
+                'histograms': [[name, list(key), values]
+                               for (name, key), values in self.histograms.items()]
+            }
+
+    def flush(self):
+        """
+        Write the values of the process to its file.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        if self.name is None:
+            self.name = f'{os.getpid()}-{uuid.uuid4().hex}'
+        path = os.path.join(self.folder, f'{self.name}.json')
+        temporary = f'{path}.{threading.get_ident()}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temporary, path)
+
+    def collect(self):
+        """
+        Add up the values of all the live processes and of the stopped ones.
+
+        :return: a tuple (counters, histograms) of dictionaries by (name, labels)
+        """
+        self.flush()
+        self.merge_stopped()
+        counters = {}
+        histograms = {}
+        paths = [os.path.join(self.folder, entry) for entry in os.listdir(self.folder)
+                 if entry.endswith('.json')]
+        for path in paths:
+            values = read_values(path)
+            if values is not None:
+                add_values(counters, histograms, values)
+        return counters, histograms
+
+    def merge_stopped(self):
+        """
+        Merge the counters and histograms of the stopped processes into the aggregate file, and
+        remove their files.
+
+        A lock file keeps the processes collecting at the same time from merging a file twice.
+        """
+        with open(os.path.join(self.folder, 'aggregate.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stopped = []
+            for entry in os.listdir(self.folder):
+                name, extension = os.path.splitext(entry)
+                pid = name.split('-')[0]
+                if extension == '.json' and pid.isdigit() and not is_alive(int(pid)):
+                    stopped.append(os.path.join(self.folder, entry))
+            if len(stopped) == 0:
+                return
+            aggregate = os.path.join(self.folder, 'aggregate.json')
+            counters = {}
+            histograms = {}
+            add_values(counters, histograms, read_values(aggregate) or {})
+            for path in stopped:
+                add_values(counters, histograms, read_values(path) or {}, gauges=False)
+            temporary = f'{aggregate}.{os.getpid()}.tmp'
+            with open(temporary, 'w') as f:
+                json.dump({
+                    'counters': [[name, list(key), value]
+                                 for (name, key), value in counters.items()],
+                    'histograms': [[name, list(key), values]
+                                   for (name, key), values in histograms.items()]
+                }, f)
+            os.replace(temporary, aggregate)
+            for path in stopped:
+                os.remove(path)
+
+    def _touch(self):
+        self.dirty = True
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            if self.dirty:
+                self.dirty = False
+                try:
+                    self.flush()
+                except OSError:
+                    self.dirty = True
+
+
+def read_values(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def add_values(counters, histograms, values, gauges=True):
+    """
+    Add the values of a metrics file to totals.
+
+    :param counters: the totals of the counters and gauges, by (name, labels)
+    :param histograms: the totals of the histograms, by (name, labels)
+    :param values: the content of the file
+    :param gauges: if the gauges are added too
+    """
+    for name, key, value in values.get('counters', []):
+        if not gauges and descriptions.get(name, ('untyped',))[0] == 'gauge':
+            continue
+        key = (name, tuple(tuple(label) for label in key))
+        counters[key] = counters.get(key, 0) + value
+    for name, key, value in values.get('histograms', []):
+        key = (name, tuple(tuple(label) for label in key))
+        total = histograms.setdefault(key, [0] * len(value))
+        for i, v in enumerate(value):
+            total[i] += v
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(key, extra=()):
+    labels = list(key) + list(extra)
+    if len(labels) == 0:
+        return ''
+    values = ','.join(f'{name}="{escape(value)}"' for name, value in labels)
+    return '{' + values + '}'
+
+
+def exposition():
+    """
+    Format the metrics of all the processes in the Prometheus text format.
+
+    :return: the text
+    """
+    counters, histograms = metrics.collect()
+    lines = []
+    names = sorted({name for name, _ in counters} | {name for name, _ in histograms})
+    for name in names:
+        kind, description = descriptions.get(name, ('untyped', name))
+        lines.append(f'# HELP {prefix}{name} {description}')
+        lines.append(f'# TYPE {prefix}{name} {kind}')
+        for (n, key), value in sorted(counters.items()):
+            if n == name:
+                lines.append(f'{prefix}{name}{format_labels(key)} {value}')
+        for (n, key), values in sorted(histograms.items()):
+            if n != name:
+                continue
+            for bound, count in zip(buckets, values):
+                lines.append(f'{prefix}{name}_bucket{format_labels(key, [("le", bound)])} {count}')
+            lines.append(f'{prefix}{name}_bucket{format_labels(key, [("le", "+Inf")])} '
+                         f'{values[-1]}')
+            lines.append(f'{prefix}{name}_sum{format_labels(key)} {values[-2]}')
+            lines.append(f'{prefix}{name}_count{format_labels(key)} {values[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+metrics = Registry(make_path(getattr(env, 'metrics_folder', '../metrics')),
+                   getattr(env, 'metrics_flush_interval', 1))
+os.register_at_fork(after_in_child=metrics.reset)
@@ -1,7 +1,8 @@
 from functools import wraps
-from flask import request
+from flask import request, g
 from flask_login import current_user
 
+from polydrive import app
 from polydrive.models import Resource, Version, resource_type, User
 from polydrive.services import resource_action
 from polydrive.services.messages import not_found, unauthorized, bad_request
@@ -27,9 +28,47 @@ def extract_parameter(param_name):
     return param
 
 
+def extract_tree_options():
+    """
+    Read the options of a tree serialization in the query string.
+
+    The depth limits the levels of children, the limit and cursor paginate the children of each
+    folder, and the stream flag asks for a streamed response.
+
+    :return: a dictionary of options, None if one of them is invalid
+    """
+    options = {'stream': request.args.get('stream', 'false').lower() in ['1', 'true']}
+    for name, minimum in [('depth', 0), ('limit', 1), ('cursor', 0)]:
+        value = request.args.get(name, None)
+        if value is not None:
+            try:
+                value = int(value)
+            except ValueError:
+                return None
+            if value < minimum:
+                return None
+        options[name] = value
+    return options
+
+
+def replica_middleware(f):
+    """
+    Run the queries of a read-only view on the read replica, if one is configured.
+    """
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.use_replica = 'replica' in (app.config['SQLALCHEMY_BINDS'] or {})
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
 def resource_middleware(**options):
     """
     Check if the user can access the requested resource.
+
+    The resource is stored in g.resource, None if no resource id was given.
     """
     action = options.get('action', resource_action.read)
     required = options.get('required', True)
@@ -39,6 +78,7 @@ def resource_middleware(**options):
         @wraps(f)
         def wrapper(*args, **kwargs):
             res_id = extract_parameter(key)
+            g.resource = None
             if res_id is None:
                 if not required:
                     return f(*args, **kwargs)
@@ -49,6 +89,7 @@ def resource_middleware(**options):
                 return not_found('This resource does not exist.')
             if not check_resource_rights(res, current_user, action):
                 return unauthorized('You cannot access this resource.')
+            g.resource = res
             return f(*args, **kwargs)
 
         return wrapper
@@ -60,14 +101,12 @@ def file_middleware(f):
     """
     Check if the requested resource is a file.
 
-    This decorator must always be called after @rights_middleware().
+    This decorator must always be called after @resource_middleware().
     """
 
     @wraps(f)
     def wrapper(*args, **kwargs):
-        res_id = extract_parameter('res_id')
-        file = Resource.query.get(res_id)
-        if file.type != resource_type.file:
+        if g.resource.type != resource_type.file:
             return bad_request('Resource is not a file.')
         return f(*args, **kwargs)
 
@@ -78,18 +117,19 @@ def file_version_middleware(f):
     """
     Check if the requested file version exists.
 
-    This decorator must always be called after @rights_middleware().
+    This decorator must always be called after @resource_middleware(). The version is stored in
+    g.version.
     """
 
     @wraps(f)
     def wrapper(*args, **kwargs):
-        res_id = extract_parameter('res_id')
         version_id = extract_parameter('version_id')
-        if version_id is None or res_id is None:
+        if version_id is None:
             return bad_request('No file version id provided.')
-        version = Version.query.filter_by(id=version_id, res_id=res_id).first()
+        version = Version.query.filter_by(id=version_id, res_id=g.resource.id).first()
         if version is None:
             return not_found('This resource does not exist.')
+        g.version = version
         return f(*args, **kwargs)
 
     return wrapper
@@ -98,6 +138,8 @@ def file_version_middleware(f):
 def parent_middleware(**options):
     """
     Check if the parent is a folder and if the user can access it.
+
+    The parent is stored in g.parent, None if no parent id was given.
     """
     required = options.get('required', False)
     action = options.get('action', resource_action.read)
@@ -106,6 +148,7 @@ def parent_middleware(**options):
         @wraps(f)
         def wrapper(*args, **kwargs):
             parent_id = extract_parameter('parent_id')
+            g.parent = None
             if parent_id is None:
                 if not required:
                     return f(*args, **kwargs)
@@ -118,6 +161,7 @@ def parent_middleware(**options):
                 return bad_request('Parent is not a folder.')
             if not check_resource_rights(folder, current_user, action):
                 return unauthorized('You cannot access parent folder.')
+            g.parent = folder
             return f(*args, **kwargs)
 
         return wrapper
@@ -128,6 +172,8 @@ def parent_middleware(**options):
 def user_middleware(f):
     """
     Check if the user exists.
+
+    The user is stored in g.target_user.
     """
 
     @wraps(f)
@@ -138,6 +184,7 @@ def user_middleware(f):
         user = User.query.get(user_id)
         if user is None:
             return not_found('User not found.')
+        g.target_user = user
         return f(*args, **kwargs)
 
     return wrapper
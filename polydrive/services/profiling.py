@@ -0,0 +1,191 @@
+import cProfile
+import datetime
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from polydrive.config.files import make_path
+
+import env
+
+
+profile_folder = make_path(getattr(env, 'profile_folder', 'profiles'))
+
+
+def function_label(filename, line, name):
+    if filename == '~':
+        return name
+    return f'{filename}:{line}({name})'
+
+
+class CProfileRecorder:
+    """
+    Profile a request with cProfile, which counts every call but slows the request down.
+    """
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def functions(self):
+        """
+        Get the time spent in each function.
+
+        :return: a dictionary of [calls, own time, cumulative time] lists by function
+        """
+        return {function_label(*key): [calls, own, cumulative]
+                for key, (_, calls, own, cumulative, _) in
+                pstats.Stats(self.profile).stats.items()}
+
+
+class StackSampler:
+    """
+    Sample the stacks of the profiled threads at a fixed interval.
+
+    A single thread per process takes the samples, so a sampled request only pays for the
+    stacks it is caught in.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.threads = {}
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def register(self, thread_id):
+        """
+        Start sampling a thread.
+
+        :param thread_id: the thread's identifier
+        :return: a Counter of the sampled stacks, innermost function first
+        """
+        samples = Counter()
+        with self.lock:
+            self.threads[thread_id] = samples
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self._sample_loop, daemon=True).start()
+        return samples
+
+    def unregister(self, thread_id):
+        with self.lock:
+            self.threads.pop(thread_id, None)
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if len(self.threads) == 0:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, samples in self.threads.items():
+                    frame = frames.get(thread_id, None)
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(function_label(code.co_filename, code.co_firstlineno,
+                                                    code.co_name))
+                        frame = frame.f_back
+                    if len(stack) > 0:
+                        samples[tuple(stack)] += 1
+
+
+sampler = StackSampler(getattr(env, 'profile_sampler_interval', 0.005))
+
+
+class SampleRecorder:
+    """
+    Profile a request with the stack sampler, which barely slows it down but does not count
+    calls and misses the functions shorter than the sampling interval.
+    """
+
+    def __init__(self):
+        self.thread_id = threading.get_ident()
+        self.samples = None
+
+    def start(self):
+        self.samples = sampler.register(self.thread_id)
+
+    def stop(self):
+        sampler.unregister(self.thread_id)
+
+    def functions(self):
+        functions = {}
+        for stack, count in self.samples.items():
+            elapsed = count * sampler.interval
+            functions.setdefault(stack[0], [0, 0.0, 0.0])[1] += elapsed
+            for label in set(stack):
+                functions.setdefault(label, [0, 0.0, 0.0])[2] += elapsed
+        return functions
+
+
+recorders = {
+    'cprofile': CProfileRecorder,
+    'sampler': SampleRecorder
+}
+
+
+def dump_profile(details, functions):
+    """
+    Write the profile of a request to the profile folder.
+
+    The oldest profiles are removed when the folder holds more than profile_max_dumps of them.
+
+    :param details: the description of the request
+    :param functions: the time spent in each function
+    """
+    os.makedirs(profile_folder, exist_ok=True)
+    now = datetime.datetime.now()
+    name = f'{now:%Y%m%d-%H%M%S}-{os.getpid()}-{uuid.uuid4().hex[:8]}.json'
+    with open(os.path.join(profile_folder, name), 'w') as f:
+        json.dump(dict(details, functions=functions), f)
+    dumps = sorted(entry for entry in os.listdir(profile_folder) if entry.endswith('.json'))
+    for entry in dumps[:max(0, len(dumps) - getattr(env, 'profile_max_dumps', 500))]:
+        try:
+            os.remove(os.path.join(profile_folder, entry))
+        except FileNotFoundError:
+            pass
+
+
+def aggregate_profiles(endpoint=None):
+    """
+    Add up the profiles of the profile folder.
+
+    :param endpoint: only count the profiles of this endpoint, None for all endpoints
+    :return: a tuple (number of profiles, total duration, dictionary of
+        [calls, own time, cumulative time, number of profiles] lists by function)
+    """
+    count = 0
+    duration = 0.0
+    functions = {}
+    if not os.path.isdir(profile_folder):
+        return count, duration, functions
+    for entry in sorted(os.listdir(profile_folder)):
+        if not entry.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(profile_folder, entry)) as f:
+                profile = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if endpoint is not None and profile['endpoint'] != endpoint:
+            continue
+        count += 1
+        duration += profile['duration']
+        for label, (calls, own, cumulative) in profile['functions'].items():
+            total = functions.setdefault(label, [0, 0.0, 0.0, 0])
+            total[0] += calls
+            total[1] += own
+            total[2] += cumulative
+            total[3] += 1
+    return count, duration, functions
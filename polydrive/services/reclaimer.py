@@ -0,0 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from polydrive import app
+
+import env
+
+
+executor = ThreadPoolExecutor(max_workers=getattr(env, 'reclaimer_workers', 1))
+
+
+def run(task, *args):
+    with app.app_context():
+        try:
+            task(*args)
+        except Exception:
+            app.logger.exception('Background reclamation failed.')
+
+
+def submit(task, *args):
+    """
+    Run a task in a background thread, within an application context.
+
+    :param task: the function to run
+    :param args: the function's arguments
+    :return: the future of the task
+    """
+    return executor.submit(run, task, *args)
@@ -1,23 +1,229 @@
+from flask import g
+from sqlalchemy.orm.attributes import set_committed_value
+
+from polydrive.config import db
 from polydrive.services import resource_action
-from polydrive.models import role_type, Resource
+from polydrive.services.cache import rights_cache, rights_generation
+from polydrive.services.encoding import dumps
+from polydrive.services.metrics import metrics
+from polydrive.models import role_type, Role, Counter, Resource, resource_type, Ancestry, \
+    Version, User
+
+
+def sync_rights():
+    """
+    Check the rights cache generation against the database, once per request.
+    """
+    if not g.get('rights_synced', False):
+        rights_cache.sync(Counter.get(rights_generation))
+        g.rights_synced = True
+
+
+def get_role_type(res, user):
+    """
+    Get the effective role of a user on a resource, using the rights cache.
+
+    The cache generation is checked against the database once per request.
+
+    :param res: the resource
+    :param user: the user
+    :return: the role type, None if the resource is not shared with the user
+    """
+    sync_rights()
+    found, r_type = rights_cache.get(user.id, res.id)
+    if not found:
+        role = Role.get_rights(res, user)
+        r_type = role.type if role is not None else None
+        rights_cache.set(user.id, res.id, r_type)
+    return r_type
 
 
-def check_resource_rights(res, user, action):
+def load_role_types(resources, user):
+    """
+    Get the effective roles of a user on many resources at once, using the rights cache.
+
+    The nearest roles of the resources missing from the cache are found through the ancestries
+    with a single query per 500 resources, and stored in the cache.
+
+    :param resources: the resources
+    :param user: the user
+    :return: a dictionary of role types by resource id, None when a resource is not shared
+        with the user
+    """
+    sync_rights()
+    role_types = {}
+    missing = []
+    for res in resources:
+        found, r_type = rights_cache.get(user.id, res.id)
+        if found:
+            role_types[res.id] = r_type
+        else:
+            missing.append(res.id)
+    for i in range(0, len(missing), 500):
+        batch = missing[i:i + 500]
+        nearest = {res_id: None for res_id in batch}
+        rows = db.session.query(Ancestry.descendant_id, Role.type) \
+            .join(Role, Role.res_id == Ancestry.ancestor_id) \
+            .filter(Ancestry.descendant_id.in_(batch), Role.user_id == user.id) \
+            .order_by(Ancestry.descendant_id, Ancestry.depth.desc())
+        for res_id, r_type in rows:
+            nearest[res_id] = r_type
+        for res_id, r_type in nearest.items():
+            rights_cache.set(user.id, res_id, r_type)
+            role_types[res_id] = r_type
+    return role_types
+
+
+def check_resource_rights(res, user, action, role_types=None):
     """
     Check if a user can access a resource.
 
     :param res: resource to check
     :param user: user accessing the resource
     :param action: ongoing action's type
+    :param role_types: the roles of the user loaded by load_role_types, None to look for the
+        role of the resource
     :return: if the user can perform the action
     """
+    allowed = False
     if res is not None:
         if res.owner_id == user.id:
-            return True
-        role = Resource.get_rights(res, user)
-        if role is not None:
-            if action == resource_action.read:
-                return True
-            if action == resource_action.write:
-                return role.type == role_type.edit
-    return False
+            allowed = True
+        else:
+            if role_types is not None and res.id in role_types:
+                r_type = role_types[res.id]
+            else:
+                r_type = get_role_type(res, user)
+            if r_type is not None:
+                if action == resource_action.read:
+                    allowed = True
+                elif action == resource_action.write:
+                    allowed = r_type == role_type.edit
+    metrics.inc('rights_checks_total', action=action, result='allowed' if allowed else 'denied')
+    return allowed
+
+
+def load_trees(roots, depth=None):
+    """
+    Load the hierarchies of several resources at once.
+
+    The descendants are fetched in a single query through the ancestries, then their versions,
+    roles and users are fetched with one query each. The relationships are filled in memory so
+    serializing the trees does not issue any other query.
+
+    :param roots: the resources whose hierarchy is loaded
+    :param depth: the number of levels of children to load, None for the whole hierarchy
+    :return: the roots
+    """
+    if len(roots) == 0:
+        return roots
+    subtree = db.session.query(Ancestry.descendant_id) \
+        .filter(Ancestry.ancestor_id.in_({r.id for r in roots}))
+    if depth is not None:
+        subtree = subtree.filter(Ancestry.depth <= depth)
+    subtree = subtree.subquery()
+    resources = {r.id: r for r in Resource.query.filter(Resource.id.in_(subtree))}
+    versions = Version.query.filter(Version.res_id.in_(subtree)).order_by(Version.id).all()
+    roles = Role.query.filter(Role.res_id.in_(subtree)).all()
+    user_ids = {r.owner_id for r in resources.values()} | {r.user_id for r in roles}
+    users = {}
+    for i in range(0, len(user_ids), 500):
+        for user in User.query.filter(User.id.in_(list(user_ids)[i:i + 500])):
+            users[user.id] = user
+
+    children = {}
+    res_versions = {}
+    res_roles = {}
+    for version in versions:
+        res_versions.setdefault(version.res_id, []).append(version)
+        set_committed_value(version, 'file', resources[version.res_id])
+    for role in roles:
+        res_roles.setdefault(role.res_id, []).append(role)
+        set_committed_value(role, 'resource', resources[role.res_id])
+        set_committed_value(role, 'user', users[role.user_id])
+    for res in sorted(resources.values(), key=lambda r: r.id):
+        set_committed_value(res, 'owner', users[res.owner_id])
+        set_committed_value(res, 'versions', res_versions.get(res.id, []))
+        set_committed_value(res, 'roles', res_roles.get(res.id, []))
+        if res.parent_id in resources:
+            set_committed_value(res, 'parent', resources[res.parent_id])
+            children.setdefault(res.parent_id, []).append(res)
+
+    def fill_children(res, remaining):
+        if res.type != resource_type.folder or remaining == 0:
+            return
+        set_committed_value(res, 'children', children.get(res.id, []))
+        for child in res.children:
+            fill_children(child, remaining - 1 if remaining is not None else None)
+
+    for root in roots:
+        fill_children(root, depth)
+    return roots
+
+
+def iter_resources(query, cursor=None):
+    """
+    Iterate over resources by increasing id without loading them all at once.
+
+    :param query: the query of resources
+    :param cursor: only return resources with a greater id
+    :return: the ordered query
+    """
+    if cursor is not None:
+        query = query.filter(Resource.id > cursor)
+    return query.options(db.lazyload('*')).order_by(Resource.id).yield_per(100)
+
+
+def stream_tree(res, depth=None, limit=None, cursor=None):
+    """
+    Serialize a resource with its descendants as a stream of JSON fragments.
+
+    Children are fetched folder by folder while the fragments are consumed, so only the current
+    branch is held in memory.
+
+    :param res: the resource
+    :param depth: the number of levels of children to include, None for the whole hierarchy
+    :param limit: the maximum number of children listed per folder, None for all of them
+    :param cursor: list only the direct children with a greater id
+    :return: a generator of JSON fragments
+    """
+    node = dumps(res.node)
+    if res.type != resource_type.folder or depth == 0:
+        yield node
+        return
+    yield node[:-1] + ', "children": ['
+    children = iter_resources(Resource.query.filter_by(parent_id=res.id), cursor)
+    if limit is not None:
+        children = children.limit(limit + 1)
+    child_depth = depth - 1 if depth is not None else None
+    next_cursor = None
+    for i, child in enumerate(children):
+        if i == limit:
+            break
+        if i > 0:
+            yield ', '
+        yield from stream_tree(child, child_depth, limit)
+        next_cursor = child.id
+    else:
+        next_cursor = None
+    yield ']'
+    if next_cursor is not None:
+        yield f', "next_cursor": {next_cursor}'
+    yield '}'
+
+
+def stream_list(resources, depth=None, limit=None):
+    """
+    Serialize a list of resources with their descendants as a stream of JSON fragments.
+
+    :param resources: an iterable of resources
+    :param depth: the number of levels of children to include, None for the whole hierarchy
+    :param limit: the maximum number of children listed per folder, None for all of them
+    :return: a generator of JSON fragments
+    """
+    yield '['
+    for i, res in enumerate(resources):
+        if i > 0:
+            yield ', '
+        yield from stream_tree(res, depth, limit)
+    yield ']'
@@ -0,0 +1,24 @@
+import os
+import re
+
+from polydrive import app
+from polydrive.models import Blob
+
+
+def shard_upload_folder():
+    """
+    Move the blobs stored at the root of the upload folder into their sharded directories.
+
+    Files are renamed in place, so the migration can be interrupted and run again.
+
+    :return: the number of moved blobs
+    """
+    folder = app.config['UPLOAD_FOLDER']
+    moved = 0
+    for entry in os.scandir(folder):
+        if entry.is_file() and re.fullmatch('[0-9a-f]{64}', entry.name):
+            path = Blob.path_of(entry.name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(entry.path, path)
+            moved += 1
+    return moved
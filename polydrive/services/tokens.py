@@ -0,0 +1,141 @@
+import datetime
+import threading
+import time
+import uuid
+
+import jwt
+
+from polydrive.config import db
+from polydrive.models import RevokedToken
+
+import env
+
+
+access_type = 'access'
+refresh_type = 'refresh'
+algorithm = 'HS256'
+
+
+def load_signing_keys():
+    """
+    Read the keys tokens can be signed with, by key id.
+
+    Tokens are signed with the current key, and the previous keys are kept to verify the
+    tokens issued before a rotation. Without configured keys, the secret key is used.
+
+    :return: a tuple (current key id, dictionary of keys)
+    """
+    keys = getattr(env, 'jwt_keys', None)
+    key_id = getattr(env, 'jwt_key_id', None)
+    if keys is None and key_id is None:
+        return 'default', {'default': env.secret_key}
+    if keys is None or key_id not in keys:
+        raise ValueError('jwt_key_id must be the id of one of the jwt_keys, '
+                         'set both of them in env.py or neither')
+    return key_id, keys
+
+
+signing_keys = load_signing_keys()
+
+
+def make_token(user, token_type, ttl):
+    key_id, keys = signing_keys
+    now = int(time.time())
+    claims = {
+        'sub': str(user.id),
+        'username': user.username,
+        'email': user.email,
+        'type': token_type,
+        'jti': uuid.uuid4().hex,
+        'iat': now,
+        'exp': now + ttl
+    }
+    return jwt.encode(claims, keys[key_id], algorithm=algorithm,
+                      headers={'kid': key_id}).decode('ascii')
+
+
+def issue_tokens(user):
+    """
+    Issue a short-lived access token and a refresh token for a user.
+
+    :param user: the user
+    :return: a key-value dictionary
+    """
+    access_ttl = getattr(env, 'jwt_access_ttl', 900)
+    return {
+        'token_type': 'Bearer',
+        'access_token': make_token(user, access_type, access_ttl),
+        'expires_in': access_ttl,
+        'refresh_token': make_token(user, refresh_type, getattr(env, 'jwt_refresh_ttl', 2592000))
+    }
+
+
+def decode_token(token, token_type=None):
+    """
+    Verify a token and read its claims.
+
+    :param token: the encoded token
+    :param token_type: the expected type of token, None to accept any type
+    :return: the claims, None if the token is invalid, expired or revoked
+    """
+    try:
+        key_id = jwt.get_unverified_header(token).get('kid', None)
+        key = signing_keys[1].get(key_id, None)
+        if key is None:
+            return None
+        claims = jwt.decode(token, key, algorithms=[algorithm])
+    except jwt.InvalidTokenError:
+        return None
+    if token_type is not None and claims.get('type', None) != token_type:
+        return None
+    if revocation_list.contains(claims['jti']):
+        return None
+    return claims
+
+
+class RevocationList:
+    """
+    The identifiers of the revoked tokens which have not expired yet.
+
+    The list is held in memory and reloaded from the database at a fixed interval, so checking
+    a token does not issue any query. Tokens revoked by another process are rejected once the
+    list is reloaded.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.jtis = set()
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def contains(self, jti):
+        with self.lock:
+            if self.loaded is None or self.loaded + self.interval < time.monotonic():
+                now = datetime.datetime.utcnow()
+                self.jtis = {row.jti for row in db.session.query(RevokedToken.jti)
+                             .filter(RevokedToken.expires > now)}
+                self.loaded = time.monotonic()
+            return jti in self.jtis
+
+    def add(self, jti):
+        with self.lock:
+            self.jtis.add(jti)
+
+
+revocation_list = RevocationList(getattr(env, 'jwt_revocation_refresh', 30))
+
+
+def revoke_token(claims):
+    """
+    Revoke a token until it expires.
+
+    The expired revocations are removed at the same time, so the list stays small.
+
+    :param claims: the claims of the token
+    """
+    now = datetime.datetime.utcnow()
+    RevokedToken.query.filter(RevokedToken.expires <= now).delete(synchronize_session=False)
+    if RevokedToken.query.get(claims['jti']) is None:
+        db.session.add(RevokedToken(jti=claims['jti'],
+                                    expires=datetime.datetime.utcfromtimestamp(claims['exp'])))
+    revocation_list.add(claims['jti'])
@@ -0,0 +1,162 @@
+import hashlib
+import os
+import tempfile
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from polydrive import app
+from polydrive.services.messages import too_large
+
+import env
+
+
+chunk_size = 64 * 1024
+max_files = getattr(env, 'upload_max_files', 10000)
+# The WSGI environment key of a form already parsed by the server.
+form_environ_key = 'polydrive.form'
+
+
+class UploadStream:
+    """
+    A file uploaded into the upload folder while the request body is parsed.
+
+    The content is hashed and counted as it is written, and the file is moved to its final
+    location without being copied. If it is never saved, the file is removed when the request
+    is closed.
+    """
+
+    def __init__(self, folder):
+        fd, self.path = tempfile.mkstemp(prefix='.upload-', dir=folder)
+        self._file = os.fdopen(fd, 'w+b')
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.saved = False
+
+    @property
+    def file(self):
+        """
+        The uploaded file, opened again at its start if it was released.
+        """
+        if self._file is None:
+            self._file = open(self.path, 'r+b')
+        return self._file
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    @property
+    def sha256(self):
+        return self.hash.hexdigest()
+
+    def release(self):
+        """
+        Close the file until it is used again, so a request can upload many files without
+        holding a descriptor for each of them.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def save(self, path):
+        """
+        Move the uploaded file to its final location.
+
+        :param path: the destination path
+        """
+        self.release()
+        os.replace(self.path, path)
+        self.saved = True
+
+    def close(self):
+        self.release()
+        if not self.saved:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class TooManyFiles(RequestEntityTooLarge):
+    description = f'A request cannot upload more than {max_files} files.'
+
+
+@app.errorhandler(TooManyFiles)
+def too_many_files(error):
+    return too_large(error.description)
+
+
+class UploadRequest(Request):
+    """
+    A request writing its uploaded files straight into the upload folder.
+
+    The parts are received one after the other, so the file of a part is released when the
+    next one starts. The parsing stops at the upload_max_files setting, before the next files
+    are written. Servers can also parse the form themselves, like the transfer server.
+    """
+    upload_streams = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        if self.upload_streams is None:
+            self.upload_streams = []
+        elif len(self.upload_streams) >= max_files:
+            for stream in self.upload_streams:
+                stream.close()
+            raise TooManyFiles()
+        else:
+            self.upload_streams[-1].release()
+        self.upload_streams.append(UploadStream(app.config['UPLOAD_FOLDER']))
+        return self.upload_streams[-1]
+
+    def _load_form_data(self):
+        """
+        Use the form parsed by the server if there is one, instead of parsing the body again.
+        """
+        if form_environ_key in self.environ and 'form' not in self.__dict__:
+            self.__dict__['form'], self.__dict__['files'] = self.environ[form_environ_key]
+        super()._load_form_data()
+
+
+def split_path(path):
+    """
+    Split the path of an uploaded file, relative to the folder receiving it.
+
+    :param path: the relative path, with slashes or backslashes
+    :return: the list of names, None if the path is invalid
+    """
+    names = [name for name in path.replace('\\', '/').split('/') if name not in ['', '.']]
+    if len(names) == 0 or '..' in names:
+        return None
+    return names
+
+
+def receive_upload(buffer):
+    """
+    Get an uploaded file as an UploadStream.
+
+    Files parsed by an UploadRequest are already in the upload folder, other streams are copied
+    there by chunks.
+
+    :param buffer: the uploaded file
+    :return: the uploaded content
+    """
+    if isinstance(buffer.stream, UploadStream):
+        return buffer.stream
+    stream = UploadStream(app.config['UPLOAD_FOLDER'])
+    chunk = buffer.stream.read(chunk_size)
+    while len(chunk) > 0:
+        stream.write(chunk)
+        chunk = buffer.stream.read(chunk_size)
+    return stream
+
+
+app.request_class = UploadRequest
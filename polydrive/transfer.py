@@ -0,0 +1,246 @@
+"""
+An asynchronous server for the file transfer endpoints.
+
+Slow clients only hold a coroutine while their upload is received or their download is sent,
+instead of a whole worker. The requests are still handled by the Flask views, with the same
+middleware and permission checks, in a bounded thread pool: the request body is received on
+the disk before the view runs, and the response body is read from the disk block by block.
+The files of multi-part bodies are parsed while they are received, straight into the upload
+folder, so each uploaded byte is written once.
+
+Run it with the manager's run_transfer command, or with gunicorn:
+
+    gunicorn polydrive.transfer:application --worker-class aiohttp.GunicornWebWorker
+
+The other endpoints must still be served by the WSGI server.
+"""
+import asyncio
+import io
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web, BodyPartReader
+from multidict import CIMultiDict
+from werkzeug.datastructures import FileStorage, Headers, MultiDict
+
+from polydrive import app
+from polydrive.services.messages import ApiMessage
+from polydrive.services.upload import chunk_size, UploadStream, form_environ_key, max_files, \
+    TooManyFiles
+
+import env
+
+
+executor = ThreadPoolExecutor(max_workers=getattr(env, 'transfer_threads', 32))
+
+routes = [
+    ('POST', '/res/upload'),
+    ('POST', r'/res/upload/{parent_id:\d+}'),
+    ('POST', '/res/upload/tree'),
+    ('POST', r'/res/upload/tree/{parent_id:\d+}'),
+    ('POST', r'/res/{res_id:\d+}/upload'),
+    ('GET', r'/res/{res_id:\d+}/download'),
+    ('GET', r'/res/{res_id:\d+}/archive'),
+    ('GET', r'/res/{res_id:\d+}/{version_id:\d+}/download'),
+]
+
+
+class FileWrapper:
+    """
+    The wsgi.file_wrapper of the server, reading the files block by block.
+
+    Files bounded to a part of their content, like the ranges of the downloads, are read up to
+    the end of the part only.
+    """
+
+    def __init__(self, file, block_size=chunk_size):
+        self.file = file
+        self.block_size = block_size
+        self.remaining = getattr(file, 'remaining', None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        size = self.block_size
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+            if size <= 0:
+                raise StopIteration
+        data = self.file.read(size)
+        if len(data) == 0:
+            raise StopIteration
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+async def receive_body(request):
+    """
+    Receive the body of a request into a temporary file of the upload folder.
+
+    :param request: the request
+    :return: the file, positioned at its start
+    """
+    loop = asyncio.get_event_loop()
+    body = await loop.run_in_executor(executor, lambda: tempfile.TemporaryFile(
+        prefix='.request-', dir=app.config['UPLOAD_FOLDER']))
+    async for data in request.content.iter_chunked(chunk_size):
+        await loop.run_in_executor(executor, body.write, data)
+    body.seek(0)
+    return body
+
+
+async def receive_form(request):
+    """
+    Receive a multi-part body, writing its files straight into the upload folder.
+
+    The file of each part is released once the part is received, so a request uploading many
+    files does not hold a descriptor for each of them. The parsing stops at the
+    upload_max_files setting, before the next files are written.
+
+    :param request: the request
+    :return: a tuple (fields, files) of MultiDicts, as parsed by Werkzeug
+    """
+    loop = asyncio.get_event_loop()
+    form = MultiDict()
+    files = MultiDict()
+    count = 0
+    try:
+        reader = await request.multipart()
+        part = await reader.next()
+        while part is not None:
+            if not isinstance(part, BodyPartReader):
+                # Nested multi-part bodies are not supported by the views.
+                await part.release()
+            elif part.filename is None:
+                form.add(part.name, await part.text())
+            else:
+                count += 1
+                if count > max_files:
+                    raise TooManyFiles()
+                stream = await loop.run_in_executor(executor, UploadStream,
+                                                    app.config['UPLOAD_FOLDER'])
+                files.add(part.name, FileStorage(
+                    stream, filename=part.filename, name=part.name,
+                    content_type=part.headers.get('Content-Type', None),
+                    headers=Headers(list(part.headers.items()))))
+                data = await part.read_chunk(chunk_size)
+                while len(data) > 0:
+                    await loop.run_in_executor(executor, stream.write, data)
+                    data = await part.read_chunk(chunk_size)
+                await loop.run_in_executor(executor, stream.release)
+            part = await reader.next()
+    except BaseException:
+        for _, buffer in files.items(multi=True):
+            buffer.close()
+        raise
+    return form, files
+
+
+def make_environ(request, body):
+    """
+    Build the WSGI environment of a request.
+
+    :param request: the request
+    :param body: the received body
+    :return: the WSGI environment
+    """
+    body.seek(0, 2)
+    length = body.tell()
+    body.seek(0)
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': request.path.encode().decode('latin-1'),
+        'QUERY_STRING': request.query_string,
+        'SERVER_NAME': request.url.host or 'localhost',
+        'SERVER_PORT': str(request.url.port or 80),
+        'SERVER_PROTOCOL': f'HTTP/{request.version.major}.{request.version.minor}',
+        'REMOTE_ADDR': request.remote or '',
+        'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+        'CONTENT_LENGTH': str(length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': FileWrapper
+    }
+    for name in request.headers.keys():
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        if key not in ['HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH']:
+            environ[key] = ','.join(request.headers.getall(name))
+    return environ
+
+
+async def transfer(request):
+    """
+    Handle a transfer request with the Flask application.
+
+    :param request: the request
+    :return: the streamed response
+    """
+    loop = asyncio.get_event_loop()
+    form = None
+    if request.content_type == 'multipart/form-data':
+        try:
+            form = await receive_form(request)
+        except TooManyFiles as error:
+            return web.json_response(ApiMessage(code=error.code, status='PAYLOAD TOO LARGE',
+                                                messages=error.description).envelope,
+                                     status=error.code)
+        body = io.BytesIO()
+    elif not request.body_exists:
+        body = io.BytesIO()
+    else:
+        body = await receive_body(request)
+    try:
+        started = {}
+        environ = make_environ(request, body)
+        if form is not None:
+            environ[form_environ_key] = form
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = status
+            started['headers'] = headers
+
+        app_iter = await loop.run_in_executor(executor, app.wsgi_app,
+                                              environ, start_response)
+        try:
+            code, reason = started['status'].split(' ', 1)
+            response = web.StreamResponse(status=int(code), reason=reason,
+                                          headers=CIMultiDict(started['headers']))
+            await response.prepare(request)
+            content = iter(app_iter)
+            # The body is not read past its announced length.
+            remaining = response.content_length
+            while remaining is None or remaining > 0:
+                data = await loop.run_in_executor(executor, next, content, None)
+                if data is None:
+                    break
+                if remaining is not None:
+                    data = data[:remaining]
+                    remaining -= len(data)
+                await response.write(data)
+            await response.write_eof()
+            return response
+        finally:
+            if hasattr(app_iter, 'close'):
+                await loop.run_in_executor(executor, app_iter.close)
+    finally:
+        body.close()
+        if form is not None:
+            for _, buffer in form[1].items(multi=True):
+                buffer.close()
+
+
+application = web.Application()
+for method, path in routes:
+    application.router.add_route(method, path, transfer)